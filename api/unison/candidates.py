@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Per-group cache of the scored playlist candidates.
+
+Building a playlist requires loading the DJ's whole library and scoring it
+against the model of every member of the group. Instead of doing this on every
+request, the candidates of each group are kept in memory and refreshed
+incrementally:
+
+- when the DJ or their library changes, the candidates are rebuilt
+- when members join or leave the group, or when their model changes, only their
+  column of scores is (re)computed
+- tracks that were played recently are filtered out at selection time
+"""
+
+import libunison.library as library
+import libunison.predict as predict
+import libunison.utils as utils
+import numpy as np
+import random
+import threading
+
+from libunison.models import LibEntry, Track
+from storm.expr import Max
+
+
+# Maximal number of groups for which the candidates are kept in memory.
+CACHE_SIZE = 200
+
+_cache = utils.LRUCache(CACHE_SIZE)
+
+
+class Candidates(object):
+    """Scored candidate tracks of a group's playlist.
+
+    Tracks are represented as (artist, title, local_id) tuples. The tracks that
+    can be embedded in the latent space are scored, with one column of
+    log-likelihoods for each member of the group that can be modelled.
+    """
+
+    def __init__(self, master_id, version, with_feats, points, no_feats):
+        self.master_id = master_id
+        self.version = version
+        self._lock = threading.Lock()
+        self._with_feats = [info for track_id, info in with_feats]
+        self._points = points
+        self._no_feats = no_feats
+        # Maps track IDs to their positions in with_feats.
+        self._positions = dict()
+        for i, (track_id, info) in enumerate(with_feats):
+            self._positions.setdefault(track_id, list()).append(i)
+        # Maps user IDs to (serialized model, scores) pairs.
+        self._columns = dict()
+
+    @classmethod
+    def load(cls, store, master, version):
+        """Load and embed the tracks of the DJ's library.
+
+        with_feats and no_feats are lists of (track_id, info) pairs.
+        """
+        with_feats = list()
+        points = list()
+        no_feats = list()
+        rows = library.iter_library(store, master.id, stream=True)
+        for entry_id, local_id, track_id, artist, title, features in rows:
+            info = (artist, title, local_id)
+            if features is not None:
+                with_feats.append((track_id, info))
+                points.append(features[:predict.DIMENSIONS])
+            else:
+                no_feats.append((track_id, info))
+        points = predict.SCALE * np.array(points, dtype=np.float64)
+        return cls(master.id, version, with_feats, points, no_feats)
+
+    def update_scores(self, users):
+        """Bring the score columns in sync with the group's members.
+
+        Only the columns of users that joined, or whose model changed, are
+        computed.
+        """
+        models = dict()
+        for user in users:
+            model = predict.Model(user)
+            if model.is_nontrivial():
+                models[user.id] = (user.model, model.get_mixture())
+        with self._lock:
+            for uid in self._columns.keys():
+                if uid not in models:
+                    # The user left the group or cannot be modelled anymore.
+                    del self._columns[uid]
+            stale = [uid for uid, (text, mixture) in models.iteritems()
+                    if self._columns.get(uid, (None,))[0] != text]
+            if len(stale) == 0 or len(self._points) == 0:
+                return
+            matrix = predict.log_likelihoods(
+                    [models[uid][1] for uid in stale], self._points)
+            for uid, scores in zip(stale, matrix):
+                self._columns[uid] = (models[uid][0], scores)
+
+    def select(self, played, k, mode='mult'):
+        """Select the k best tracks that were not played recently.
+
+        `played` is the set of IDs of the tracks played recently, and `mode`
+        is the way the scores of the members are aggregated (see
+        predict.aggregate_log). Returns None if all the tracks have been
+        played.
+        """
+        valid = np.ones(len(self._with_feats), dtype=bool)
+        for track_id in played:
+            valid[self._positions.get(track_id, [])] = False
+        others = [info for track_id, info in self._no_feats
+                if track_id not in played]
+        if not valid.any() and len(others) == 0:
+            return None
+        indices = np.flatnonzero(valid)
+        with self._lock:
+            columns = [scores for text, scores in self._columns.itervalues()]
+        if len(columns) > 0 and len(indices) > 0:
+            agg = predict.aggregate_log(columns, mode)
+            playlist = [self._with_feats[indices[i]]
+                    for i in predict.top_k(agg[indices], k)]
+        else:
+            # Not a single user can be modelled! just pick songs randomly.
+            chosen = random.sample(indices, min(k, len(indices)))
+            playlist = [self._with_feats[i] for i in chosen]
+        # Complete with random songs for which we don't have features.
+        nb_missing = min(k - len(playlist), len(others))
+        playlist.extend(random.sample(others, nb_missing))
+        return playlist
+
+
+def get_candidates(store, group, master):
+    """Get the up-to-date candidates of a group's playlist."""
+    version = library_version(store, master)
+    candidates = _cache.get(group.id)
+    if (candidates is None or candidates.master_id != master.id
+            or candidates.version != version):
+        candidates = Candidates.load(store, master, version)
+        _cache.put(group.id, candidates)
+    candidates.update_scores(group.users)
+    return candidates
+
+
+def library_version(store, user):
+    """Get a value that changes whenever the user's library changes.
+
+    Entries are never deleted, and every change to an entry (or to the
+    features of its track) bumps its update time.
+    """
+    return store.find((Max(LibEntry.updated), Max(Track.updated)),
+            (LibEntry.user == user) & (LibEntry.track_id == Track.id)).one()
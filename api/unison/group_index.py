@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Spatial index of the active groups.
+
+The index is kept in memory and updated when groups are created in this
+process. Groups can also be deactivated (or created) by other processes, so a
+cheap aggregate over the active groups is checked every REFRESH_INTERVAL
+seconds, and the index is rebuilt when it doesn't match.
+"""
+
+import libunison.geometry as geometry
+import threading
+import time
+
+from libunison.models import Group
+from storm.expr import Count, Sum
+
+
+# Interval (in seconds) between two checks of the active groups.
+REFRESH_INTERVAL = 30
+
+_lock = threading.Lock()
+_index = None
+_version = None
+_checked = 0
+
+
+def nearest_groups(store, point, k):
+    """Find the k active groups closest to a point.
+
+    Returns a list of (group ID, distance) pairs, sorted by increasing
+    distance.
+    """
+    with _lock:
+        return _get_index(store).nearest(point, k)
+
+
+def add_group(store, group):
+    """Register a newly created (and flushed) group."""
+    global _version
+    with _lock:
+        if (_index is None or _version is None
+                or group.coordinates is None or group.id in _index):
+            return
+        _index.add(group.id, group.coordinates)
+        count, total = _version
+        _version = (count + 1, (total or 0) + group.id)
+
+
+def _get_index(store):
+    """Get the index, rebuilt if needed (must be called with the lock held)."""
+    global _index, _version, _checked
+    now = time.time()
+    if _index is not None and now - _checked < REFRESH_INTERVAL:
+        return _index
+    version = store.find((Count(Group.id), Sum(Group.id)),
+            Group.is_active).one()
+    if _index is None or version != _version:
+        rows = store.find((Group.id, Group.coordinates), Group.is_active)
+        _index = geometry.SpatialIndex((gid, point) for gid, point in rows
+                if point is not None)
+        _version = version
+    _checked = now
+    return _index
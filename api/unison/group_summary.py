@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Summaries of groups, loaded in bulk.
+
+Everything the group screens need (members, DJ, last track played) is loaded
+for a whole set of groups with a constant number of queries, instead of
+following the ORM references one group at a time.
+"""
+
+from constants import events
+from libunison.models import User, Group, Track, GroupEvent
+from storm.expr import And, Count, In, Max, Or, Select
+
+
+class GroupSummary(object):
+    """Summary of a group.
+
+    `members` is a list of (uid, nickname) pairs (None if the members were not
+    loaded), `master` is a (uid, nickname) pair or None, `last_play` is the
+    payload of the last play event or None and `track` is a dictionary with
+    the artist, title and image of the last track played, or None.
+    """
+
+    def __init__(self, gid, name, master_id):
+        self.gid = gid
+        self.name = name
+        self.master_id = master_id
+        self.nb_users = 0
+        self.members = None
+        self.master = None
+        self.last_play = None
+        self.track = None
+
+
+def load(store, gids, with_members=True, with_tracks=True, active_only=False):
+    """Load the summaries of a set of groups.
+
+    Returns a dictionary that maps group IDs to summaries. Unknown groups (and
+    inactive ones, if `active_only` is true) are left out. If `with_members`
+    is false, only the member counts are loaded; if `with_tracks` is false,
+    the last tracks played are not loaded.
+    """
+    gids = list(gids)
+    summaries = dict()
+    cond = In(Group.id, gids)
+    if active_only:
+        cond = And(cond, Group.is_active)
+    rows = store.find((Group.id, Group.name, Group.master_id), cond)
+    for gid, name, master_id in rows:
+        summaries[gid] = GroupSummary(gid, name, master_id)
+    if len(summaries) == 0:
+        return summaries
+    if with_members:
+        _load_members(store, summaries)
+    else:
+        rows = store.find((User.group_id, Count(User.id)),
+                In(User.group_id, summaries.keys())).group_by(User.group_id)
+        for gid, count in rows:
+            summaries[gid].nb_users = count
+    if with_tracks:
+        _load_tracks(store, summaries)
+    return summaries
+
+
+def _load_members(store, summaries):
+    """Load the members and the masters of the groups."""
+    nicknames = dict()
+    for summary in summaries.itervalues():
+        summary.members = list()
+    rows = store.find((User.group_id, User.id, User.nickname),
+            In(User.group_id, summaries.keys())).order_by(User.id)
+    for gid, uid, nickname in rows:
+        summaries[gid].members.append((uid, nickname))
+        summaries[gid].nb_users += 1
+        nicknames[uid] = nickname
+    # The masters are usually members of their group, but not necessarily.
+    missing = set(s.master_id for s in summaries.itervalues()
+            if s.master_id is not None and s.master_id not in nicknames)
+    if len(missing) > 0:
+        rows = store.find((User.id, User.nickname), In(User.id, list(missing)))
+        nicknames.update(rows)
+    for summary in summaries.itervalues():
+        if summary.master_id in nicknames:
+            summary.master = (summary.master_id, nicknames[summary.master_id])
+
+
+def _load_tracks(store, summaries):
+    """Load the last play event of the groups, and the matching tracks."""
+    # Event IDs increase over time, the last event has the highest ID.
+    last_ids = Select(Max(GroupEvent.id),
+            where=And(In(GroupEvent.group_id, summaries.keys()),
+                GroupEvent.event_type == events.PLAY),
+            group_by=GroupEvent.group_id)
+    plays = list(store.find(GroupEvent, In(GroupEvent.id, last_ids)))
+    if len(plays) == 0:
+        return
+    track_ids = [e.track_id for e in plays if e.track_id is not None]
+    by_id = dict((t.id, t) for t in store.find(Track, In(Track.id, track_ids)))
+    # Events recorded before the track ID was stored are matched by name.
+    names = set((e.payload.get('artist'), e.payload.get('title'))
+            for e in plays if e.track_id is None)
+    by_name = dict()
+    if len(names) > 0:
+        conds = [And(Track.artist == artist, Track.title == title)
+                for artist, title in names]
+        for track in store.find(Track, Or(*conds)):
+            by_name[(track.artist, track.title)] = track
+    for event in plays:
+        artist = event.payload.get('artist')
+        title = event.payload.get('title')
+        if event.track_id is not None:
+            row = by_id.get(event.track_id)
+        else:
+            row = by_name.get((artist, title))
+        summary = summaries[event.group_id]
+        summary.last_play = event.payload
+        summary.track = {
+          'artist': artist,
+          'title': title,
+          'image': row.image if row is not None else None,
+        }
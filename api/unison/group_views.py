@@ -1,25 +1,31 @@
 #!/usr/bin/env python
 """Group-related views."""
 
+import candidates
 import datetime
+import group_index
+import group_summary
 import hashlib
 import helpers
 import libunison.geometry as geometry
-import libunison.predict as predict
+import libunison.library as library
 import random
 import time
 
 from constants import errors, events
 from flask import Blueprint, request, g, jsonify
 from libentry_views import set_rating
-from libunison.models import User, Group, Track, LibEntry, GroupEvent
-from operator import itemgetter
+from libunison.models import User, Group, Track, GroupEvent
 from storm.expr import Desc, In
 
 
 # Maximal number of groups returned when listing groups.
 MAX_GROUPS = 10
 
+# Nb. of extra groups asked to the spatial index, in case some of them were
+# deactivated in the meantime.
+EXTRA_GROUPS = 5
+
 # Maximal number of tracks returned when asking for the next tracks.
 MAX_TRACKS = 5
 
@@ -33,26 +39,32 @@ group_views = Blueprint('group_views', __name__)
 @helpers.authenticate()
 def list_groups():
     """Get a list of groups."""
-    userloc = None
     try:
         lat = float(request.values['lat'])
         lon = float(request.values['lon'])
     except (KeyError, ValueError):
         # Sort by descending ID - new groups come first.
-        key_fct = lambda r: -1 * r.id
+        rows = g.store.find(Group, Group.is_active).order_by(Desc(Group.id))
+        nearest = [(group.id, None) for group in rows[:MAX_GROUPS]]
     else:
-        # Sort the rows according to the distance from the user's location.
-        userloc = geometry.Point(lat, lon)
-        key_fct = lambda r: geometry.distance(userloc, r.coordinates)
+        # Pick the groups closest to the user's location. The index is only
+        # refreshed periodically, and might still contain a few groups that
+        # were deactivated in the meantime.
+        nearest = group_index.nearest_groups(g.store,
+                geometry.Point(lat, lon), MAX_GROUPS + EXTRA_GROUPS)
+    summaries = group_summary.load(g.store, [gid for gid, dist in nearest],
+            with_members=False, with_tracks=False, active_only=True)
     groups = list()
-    rows = sorted(g.store.find(Group, Group.is_active), key=key_fct)
-    for group in rows[:MAX_GROUPS]:
+    for gid, dist in nearest:
+        if gid not in summaries:
+            continue
+        if len(groups) == MAX_GROUPS:
+            break
         groups.append({
-          'gid': group.id,
-          'name': group.name,
-          'nb_users': group.users.count(),
-          'distance': (geometry.distance(userloc, group.coordinates)
-                  if userloc is not None else None),
+          'gid': gid,
+          'name': summaries[gid].name,
+          'nb_users': summaries[gid].nb_users,
+          'distance': dist,
         })
     return jsonify(groups=groups)
 
@@ -71,6 +83,8 @@ def create_group():
     group = Group(name, is_active=True)
     group.coordinates = geometry.Point(lat, lon)
     g.store.add(group)
+    g.store.flush()  # Necessary to get an ID.
+    group_index.add_group(g.store, group)
     return list_groups()
 
 
@@ -84,30 +98,15 @@ def get_group_info(gid):
     - current DJ (ID & nickname)
     - info about last track
     """
-    group = g.store.get(Group, gid)
-    if group is None:
+    summary = group_summary.load(g.store, [gid]).get(gid)
+    if summary is None:
         raise helpers.BadRequest(errors.INVALID_GROUP,
                 "group does not exist")
     userdict = dict()
-    for user in group.users:
-        userdict[user.id] = {'nickname': user.nickname}
-    # Search for the last track that was played.
-    results = g.store.find(GroupEvent, (GroupEvent.event_type == events.PLAY)
-            & (GroupEvent.group == group))
-    track = None
-    play_event = results.order_by(Desc(GroupEvent.created)).first()
-    if play_event is not None:
-        artist = play_event.payload.get('artist')
-        title = play_event.payload.get('title')
-        row = g.store.find(Track, (Track.artist == artist)
-                & (Track.title == title)).one()
-        image = row.image if row is not None else None
-        track = {
-          'artist': artist,
-          'title': title,
-          'image': image,
-        }
-        for entry in play_event.payload.get('stats', []):
+    for uid, nickname in summary.members:
+        userdict[uid] = {'nickname': nickname}
+    if summary.last_play is not None:
+        for entry in summary.last_play.get('stats', []):
             if entry.get('uid') in userdict:
                 uid = entry['uid']
                 userdict[uid]['score'] = entry.get('score')
@@ -121,27 +120,20 @@ def get_group_info(gid):
           'predicted': val.get('predicted', True)
         })
     master = None
-    if group.master is not None:
+    if summary.master is not None:
         master = {
-          'uid': group.master.id,
-          'nickname': group.master.nickname
+          'uid': summary.master[0],
+          'nickname': summary.master[1]
         }
-    return jsonify(name=group.name, track=track, master=master, users=users)
+    return jsonify(name=summary.name, track=summary.track, master=master,
+            users=users)
 
 
-def get_played_filter(group):
-    played = set()
+def get_played_tracks(group):
+    """Get the IDs of the tracks played recently."""
     threshold = datetime.datetime.fromtimestamp(
             time.time() - ACTIVITY_INTERVAL)
-    events = g.store.find(GroupEvent, (GroupEvent.group == group)
-        & (GroupEvent.event_type == u'play') & (GroupEvent.created > threshold))
-    for event in events:
-        info = (event.payload.get('artist'), event.payload.get('title'))
-        played.add(info)
-    def played_filter(entry):
-        info = (entry.track.artist, entry.track.title)
-        return info not in played
-    return played_filter
+    return library.played_tracks(g.store, group.id, threshold)
 
 
 def get_playlist_id(group):
@@ -178,48 +170,20 @@ def get_tracks(master, gid):
                 "group does not exist")
     if group.master != master:
         raise helpers.Unauthorized("you are not the DJ")
-    # Get all the tracks in the master's library that haven't been played.
-    played_filter = get_played_filter(group)
-    remaining = filter(played_filter, g.store.find(LibEntry,
-            (LibEntry.user == master) & (LibEntry.is_valid == True)
-            & (LibEntry.is_local == True)))
-    if len(remaining) == 0:
+    # Get the scored tracks of the master's library, and pick the best ones
+    # among those that haven't been played.
+    playlist = candidates.get_candidates(g.store, group, master).select(
+            get_played_tracks(group), MAX_TRACKS)
+    if playlist is None:
         raise helpers.NotFound(errors.TRACKS_DEPLETED,
                 'no more tracks to play')
-    # Partition tracks based on whether we can embed them in the latent space.
-    with_feats = list()
-    points = list()
-    no_feats = list()
-    for entry in remaining:
-        point = predict.get_point(entry.track)
-        if point is not None:
-            with_feats.append(entry)
-            points.append(point)
-        else:
-            no_feats.append(entry)
-    # For the users that can be modelled: predict their ratings.
-    models = filter(lambda model: model.is_nontrivial(),
-            [predict.Model(user) for user in group.users])
-    if models is not None:
-        ratings = [model.score(points) for model in models]
-        agg = predict.aggregate(ratings)
-    else:
-        # Not a single user can be modelled! just order the songs randomly.
-        agg = range(len(with_feats))
-        random.shuffle(agg)
-    # Construct the playlist, decreasing order of scores.
-    playlist = [entry for entry, score in sorted(
-            zip(with_feats, agg), key=itemgetter(1), reverse=True)]
-    # Randomize songs for which we don't have features.
-    random.shuffle(no_feats)
-    playlist.extend(no_feats)
     # Craft the JSON response.
     tracks = list()
-    for entry in playlist[:MAX_TRACKS]:
+    for artist, title, local_id in playlist:
         tracks.append({
-          'artist': entry.track.artist,
-          'title': entry.track.title,
-          'local_id': entry.local_id,
+          'artist': artist,
+          'title': title,
+          'local_id': local_id,
         })
     return jsonify(playlist_id=get_playlist_id(group), tracks=tracks)
 
@@ -260,6 +224,7 @@ def play_track(user, gid):
           'predicted': True #if random.random() > 0.2 else False
         })
     event = GroupEvent(group, user, events.PLAY, payload)
+    event.track = track
     g.store.add(event)
     return helpers.success()
 
@@ -2,7 +2,13 @@
 
 import base64
 import functools
+import hashlib
+import hmac
+import libunison.messaging as messaging
 import libunison.password as password
+import libunison.utils as utils
+import os
+import time
 import werkzeug.exceptions
 
 from constants import errors
@@ -10,10 +16,39 @@ from flask import Response, jsonify, request, g
 from libunison.models import User
 
 
-def authenticate(with_user=False):
+# Verified credentials are remembered for a while, to avoid hashing the
+# password on every request.
+CREDENTIALS_CACHE_SIZE = 10000
+CREDENTIALS_TTL = 60 * 5  # In seconds.
+
+# Maps keyed hashes of (email, password) to (user ID, password hash) pairs. The
+# key is random and never leaves the process.
+_credentials = utils.LRUCache(CREDENTIALS_CACHE_SIZE, ttl=CREDENTIALS_TTL)
+_credentials_key = os.urandom(32)
+
+# Tokens are sent as "Authorization: Token <token>".
+TOKEN_SCHEME = 'Token'
+TOKEN_TTL = 60 * 60 * 24  # In seconds.
+
+# Used to sign the tokens if no secret is configured. Such tokens are only
+# valid for the process that issued them.
+_token_secret = os.urandom(32)
+
+
+def authenticate(with_user=False, allow_token=True):
     def decorator(fn):
         @functools.wraps(fn)
         def wrapper(*args, **kwargs):
+            header = request.headers.get('Authorization', '')
+            if allow_token and header.startswith(TOKEN_SCHEME + ' '):
+                # Token authentication, no need to check the password.
+                user = check_token(header[len(TOKEN_SCHEME) + 1:].strip())
+                if user is None:
+                    raise Unauthorized("invalid or expired token")
+                if with_user:
+                    return fn(user, *args, **kwargs)
+                else:
+                    return fn(*args, **kwargs)
             if request.authorization is None:
                 raise Unauthorized()
             try:
@@ -23,11 +58,9 @@ def authenticate(with_user=False):
                         request.authorization.password).decode('utf-8')
             except:
                 raise Unauthorized("could not decode email / password")
-            user = g.store.find(User, User.email == email).one()
+            user = get_user(email, pw)
             if user is None:
                 raise Unauthorized()
-            if not password.verify(pw, user.password):
-                raise Unauthorized()
             if with_user:
                 return fn(user, *args, **kwargs)
             else:
@@ -36,6 +69,100 @@ def authenticate(with_user=False):
     return decorator
 
 
+def make_token(user):
+    """Issue a signed token for a user.
+
+    Returns the token and its expiration time (as a UNIX timestamp). The
+    signature covers a fingerprint of the user's password hash, so that
+    changing the password revokes the outstanding tokens.
+    """
+    ttl = g.config.get('auth', {}).get('token_ttl', TOKEN_TTL)
+    expires = int(time.time()) + ttl
+    message = "%d:%d" % (user.id, expires)
+    return "%s:%s" % (message, _sign(message, user)), expires
+
+
+def check_token(token):
+    """Get the user of a token, or None if it is invalid or has expired."""
+    try:
+        uid, expires, signature = token.encode('ascii').split(':')
+        uid, expires = int(uid), int(expires)
+    except (ValueError, UnicodeError):
+        return None
+    if expires < time.time():
+        return None
+    user = g.store.get(User, uid)
+    if user is None:
+        return None
+    if not _compare(signature, _sign("%d:%d" % (uid, expires), user)):
+        return None
+    return user
+
+
+def _sign(message, user):
+    secret = g.config.get('auth', {}).get('secret') or _token_secret
+    fingerprint = hashlib.sha256(user.password.encode('utf-8')).hexdigest()
+    return hmac.new(secret, "%s:%s" % (message, fingerprint),
+            hashlib.sha256).hexdigest()
+
+
+def _compare(a, b):
+    """Compare two strings in constant time."""
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    if len(a) != len(b):
+        return False
+    diff = 0
+    for x, y in zip(a, b):
+        diff |= ord(x) ^ ord(y)
+    return diff == 0
+
+
+def get_user(email, pw):
+    """Get the user matching the credentials, or None if they are invalid."""
+    key = _credentials_digest(email, pw)
+    cached = _credentials.get(key)
+    if cached is not None:
+        uid, hashed = cached
+        user = g.store.get(User, uid)
+        # The e-mail or the password might have changed in the meantime.
+        if (user is not None and user.email == email
+                and user.password == hashed):
+            return user
+        _credentials.pop(key)
+    user = g.store.find(User, User.email == email).one()
+    if user is None or not password.verify(pw, user.password):
+        return None
+    _credentials.put(key, (user.id, user.password))
+    return user
+
+
+def forget_credentials():
+    """Drop the credentials of the current request from the cache.
+
+    Should be called when the user's e-mail or password changes.
+    """
+    try:
+        email = base64.b64decode(
+                request.authorization.username).decode('utf-8')
+        pw = base64.b64decode(request.authorization.password).decode('utf-8')
+    except:
+        return
+    _credentials.pop(_credentials_digest(email, pw))
+
+
+def _credentials_digest(email, pw):
+    message = email.encode('utf-8') + '\x00' + pw.encode('utf-8')
+    return hmac.new(_credentials_key, message, hashlib.sha256).digest()
+
+
+def get_messages():
+    """Get the batch of messages to be sent at the end of the request."""
+    if getattr(g, 'messages', None) is None:
+        g.messages = messaging.MessageBatch(messaging.get_publisher(g.config))
+    return g.messages
+
+
 def ensure_users_match(user, uid):
     if user.id != uid:
         raise Unauthorized()
@@ -59,6 +186,13 @@ class NotFound(werkzeug.exceptions.NotFound):
         self.msg = msg
 
 
+class LengthRequired(werkzeug.exceptions.LengthRequired):
+    def __init__(self, error, msg):
+        super(LengthRequired, self).__init__(msg)
+        self.error = error
+        self.msg = msg
+
+
 class Unauthorized(werkzeug.exceptions.Unauthorized):
     def __init__(self, msg='could not authenticate'):
         super(Unauthorized, self).__init__(msg)
@@ -4,14 +4,26 @@
 import helpers
 import hashlib
 import json
+import libunison.library as library
+import libunison.messaging as messaging
 import libunison.predict as predict
-import pika
+import libunison.training as training
+import zlib
 
 from constants import errors
 from flask import Blueprint, request, g, jsonify
 from libunison.models import User, Group, Track, LibEntry, GroupEvent
 
 
+# Size of the chunks read from streamed uploads.
+STREAM_CHUNK_SIZE = 64 * 1024  # In bytes.
+
+# Nb. of streamed entries staged at once.
+STREAM_BATCH_SIZE = 1000
+
+# Maximal length of a line in streamed uploads.
+MAX_LINE_LENGTH = 64 * 1024  # In bytes.
+
 libentry_views = Blueprint('libentry_views', __name__)
 
 
@@ -34,29 +46,35 @@ def init_track(track):
     generates and sends the jobs that will fetch the track's tags and other
     information.
     """
-    meta = {'artist': track.artist, 'title': track.title}
-    tags_msg = json.dumps({
-      'action': 'track-tags',
-      'track': meta,
-    })
-    info_msg = json.dumps({
-      'action': 'track-info',
-      'track': meta,
-    })
-    # Set up the connection.
-    queue = g.config['queue']['name']
-    conn = pika.BlockingConnection(
-            pika.ConnectionParameters(g.config['queue']['host']))
-    channel = conn.channel()
-    # Creates the queue if it doesn't exist yet.
-    channel.queue_declare(queue=queue, durable=True)
-    # Send the messages to the queue.
-    channel.basic_publish(exchange='', routing_key=queue, body=tags_msg,
-            properties=pika.BasicProperties(delivery_mode=2))
-    channel.basic_publish(exchange='', routing_key=queue, body=info_msg,
-            properties=pika.BasicProperties(delivery_mode=2))
-    # Closing the connection flushes all the messages.
-    conn.close()
+    init_tracks([(track.artist, track.title)])
+
+
+def init_tracks(tracks):
+    """Initialize many new tracks, given as (artist, title) pairs.
+
+    The jobs are sent at the end of the request, once the tracks have been
+    committed.
+    """
+    messages = helpers.get_messages()
+    for artist, title in tracks:
+        messages.extend(messaging.track_jobs(artist, title))
+
+
+def train_model(user, changed=None):
+    """Update the user's model.
+
+    If a training queue is configured, the job is handed to the background
+    workers and the function returns immediately.
+    """
+    queue = training.get_queue(g.config)
+    if queue is None:
+        predict.Model(user).generate(g.store, incremental=True,
+                changed=changed)
+        return
+    # We need to commit *before* sending the job, so that the worker sees the
+    # updated library.
+    g.store.commit()
+    queue.put(user.id, changed)
 
 
 def set_lib_entry(user, artist, title, local_id=None, rating=None):
@@ -68,14 +86,9 @@ def set_lib_entry(user, artist, title, local_id=None, rating=None):
     - creating a new track if it is the first time we encounte the (artist,
       title) pair
     """
-    track = g.store.find(Track, (Track.artist == artist)
-            & (Track.title == title)).one()
-    if track is None:
+    track, created = library.get_or_create_track(g.store, artist, title)
+    if created:
         # First time that we encounter this track.
-        track = Track(artist, title)
-        g.store.add(track)
-        # We need to commit *before* sending jobs to the last.fm queue.
-        g.store.commit()
         init_track(track)
         entry = None
     else:
@@ -127,8 +140,7 @@ def set_rating(user, artist, title, rating):
 def dump_library(user, uid):
     """Dump (create or replace) a user's library."""
     helpers.ensure_users_match(user, uid)
-    current_entries = local_valid_entries(user)
-    next_entries = set()
+    entries = list()
     for json_entry in request.form.getlist('entry'):
         try:
             entry = json.loads(json_entry)
@@ -138,27 +150,114 @@ def dump_library(user, uid):
         except:
             raise helpers.BadRequest(errors.INVALID_LIBENTRY,
                     "not a valid library entry")
-        key = hashlib.sha1(artist.encode('utf-8')
-                + title.encode('utf-8') + str(local_id)).digest()
-        next_entries.add(key)
-        if key not in current_entries:
-            set_lib_entry(user, artist, title, local_id=local_id)
-    # Invalidate entries that are not in the request.
-    for key, entry in current_entries.iteritems():
-        if key not in next_entries:
-            entry.is_valid = False
+        entries.append((artist, title, local_id))
+    # Diff the library against the entries in the database.
+    sync = library.LibrarySync(g.store, user.id)
+    sync.add(entries)
+    return apply_sync(user, sync)
+
+
+@libentry_views.route('/<int:uid>/stream', methods=['PUT'])
+@helpers.authenticate(with_user=True)
+def stream_library(user, uid):
+    """Dump (create or replace) a user's library, streaming the entries.
+
+    The body contains one JSON entry per line and can be gzip-compressed
+    (Content-Encoding: gzip). Entries are parsed as the body is read and are
+    staged in batches, so that the memory usage stays flat.
+    """
+    helpers.ensure_users_match(user, uid)
+    if request.content_length is None:
+        # Without it the body can't be read (e.g. chunked transfer encoding),
+        # and the whole library would be invalidated.
+        raise helpers.LengthRequired(errors.INVALID_LIBENTRY,
+                "the Content-Length header is required")
+    gzipped = request.headers.get('Content-Encoding', '').lower() == 'gzip'
+    sync = library.LibrarySync(g.store, user.id)
+    batch = list()
+    nb_entries = 0
+    try:
+        for line in iter_lines(request.stream, gzipped):
+            if line.strip() == '':
+                continue
+            try:
+                entry = json.loads(line)
+                artist = entry['artist']
+                title = entry['title']
+                local_id = int(entry['local_id'])
+            except:
+                raise helpers.BadRequest(errors.INVALID_LIBENTRY,
+                        "not a valid library entry")
+            batch.append((artist, title, local_id))
+            nb_entries += 1
+            if len(batch) >= STREAM_BATCH_SIZE:
+                sync.add(batch)
+                batch = list()
+    except zlib.error:
+        raise helpers.BadRequest(errors.INVALID_LIBENTRY,
+                "body is not valid gzip data")
+    if nb_entries == 0:
+        # Most likely a truncated upload, rather than an empty library.
+        raise helpers.BadRequest(errors.INVALID_LIBENTRY,
+                "the library is empty")
+    sync.add(batch)
+    return apply_sync(user, sync)
+
+
+def apply_sync(user, sync):
+    """Apply a library dump, and update the tracks and the user's model."""
+    changed, new_tracks = sync.apply(invalidate_missing=True)
+    init_tracks([(artist, title) for tid, artist, title in new_tracks])
     # Update the user's model.
-    g.store.flush()
-    predict.Model(user).generate(g.store)
+    train_model(user, changed)
     return helpers.success()
 
 
+def iter_lines(stream, gzipped=False):
+    """Iterate over the lines of a (possibly gzip-compressed) stream.
+
+    The stream is read (and decompressed) in chunks of fixed size. Raises
+    BadRequest if a line is longer than MAX_LINE_LENGTH.
+    """
+    rest = ''
+    for chunk in _iter_chunks(stream, gzipped):
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines + [rest]:
+            if len(line) > MAX_LINE_LENGTH:
+                raise helpers.BadRequest(errors.INVALID_LIBENTRY,
+                        "library entry is too long")
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def _iter_chunks(stream, gzipped):
+    """Iterate over the (decompressed) chunks of a stream."""
+    decomp = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    while True:
+        chunk = stream.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        if decomp is None:
+            yield chunk
+            continue
+        # Bound the size of the decompressed chunks as well.
+        while chunk:
+            yield decomp.decompress(chunk, STREAM_CHUNK_SIZE)
+            chunk = decomp.unconsumed_tail
+    if decomp is not None:
+        yield decomp.flush()
+
+
 @libentry_views.route('/<int:uid>/batch', methods=['POST'])
 @helpers.authenticate(with_user=True)
 def update_library(user, uid):
     """Update (add or delete) a user's library."""
     helpers.ensure_users_match(user, uid)
     current_entries = local_valid_entries(user)
+    changed = 0
     for json_delta in request.form.getlist('delta'):
         try:
             delta = json.loads(json_delta)
@@ -174,16 +273,18 @@ def update_library(user, uid):
         if delta_type == 'PUT':
             if key not in current_entries:
                 set_lib_entry(user, artist, title, local_id=local_id)
+                changed += 1
         elif delta_type == 'DELETE':
             if key in current_entries:
                 current_entries[key].is_valid = False
+                changed += 1
         else:
             # Unknown delta type.
             raise helpers.BadRequest(errors.INVALID_DELTA,
                     "not a valid library delta")
     # Update the user's model.
     g.store.flush()
-    predict.Model(user).generate(g.store)
+    train_model(user, changed)
     return helpers.success()
 
 
@@ -1,10 +1,9 @@
 #!/usr/bin/env python
 
 import helpers
-import yaml
+import libunison.pool as pool
 
 from flask import Flask, request, g, Response, jsonify
-from storm.locals import create_database, Store
 
 # Blueprints.
 from user_views import user_views
@@ -17,25 +16,47 @@ app.register_blueprint(user_views, url_prefix='/users')
 app.register_blueprint(group_views, url_prefix='/groups')
 app.register_blueprint(libentry_views, url_prefix='/libentries')
 
+# Configuration and database connections, reloaded when the file changes.
+_state = pool.AppState()
+
 
 @app.before_request
 def setup_request():
-    # Read the configuration.
-    stream = open('%s/config.yaml' % request.environ['UNISON_ROOT'])
-    g.config = yaml.load(stream)
-    # Set up the database.
-    database = create_database(g.config['database']['string'])
-    g.store = Store(database)
+    # Get the configuration (read once) and a store from the pool.
+    state = get_state(request.environ['UNISON_ROOT'])
+    g.config = state.config
+    g.pool = state.pool
+    g.store = g.pool.get()
 
 
 @app.after_request
-def teardown_request(response):
-    # Commit & close the database connection.
+def commit_request(response):
+    # Commit the changes made during the request.
     g.store.commit()
-    g.store.close()
     return response
 
 
+@app.teardown_request
+def teardown_request(exc):
+    # Send the messages collected during the request, once the changes have
+    # been committed.
+    messages = getattr(g, 'messages', None)
+    if messages is not None and exc is None:
+        try:
+            messages.flush()
+        except Exception as ex:
+            app.logger.error("couldn't send messages (%r)" % ex)
+    # Give the store back to the pool (even if the request failed).
+    store = getattr(g, 'store', None)
+    if store is not None:
+        g.pool.put(store)
+
+
+def get_state(root):
+    """Get the configuration and the store pool of the app."""
+    return _state.setup('%s/config.yaml' % root)
+
+
 @app.errorhandler(401)
 def handle_unauthorized(error):
     if isinstance(error, helpers.Unauthorized):
@@ -55,6 +76,15 @@ def handle_bad_request(error):
     return "bad request", 400
 
 
+@app.errorhandler(411)
+def handle_length_required(error):
+    if isinstance(error, helpers.LengthRequired):
+        response = jsonify(error=error.error, message=error.msg)
+        response.status_code = 411
+        return response
+    return "length required", 411
+
+
 @app.errorhandler(404)
 def handle_not_found(error):
     if isinstance(error, helpers.NotFound):
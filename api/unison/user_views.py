@@ -44,6 +44,19 @@ def register_user():
     return jsonify(uid=user.id)
 
 
+@user_views.route('/token', methods=['POST'])
+@helpers.authenticate(with_user=True, allow_token=False)
+def get_token(user):
+    """Issue a token that can be used instead of the e-mail and password.
+
+    The token is sent as "Authorization: Token <token>" and is valid until it
+    expires or the password is changed. Issuing a token requires the e-mail and
+    password (a token cannot be used to get a new one).
+    """
+    token, expires = helpers.make_token(user)
+    return jsonify(uid=user.id, token=token, expires=expires)
+
+
 @user_views.route('/<int:uid>/nickname', methods=['GET'])
 @helpers.authenticate()
 def get_user_nickname(uid):
@@ -84,6 +97,7 @@ def update_user_email(user, uid):
     try:
         user.email = email
         g.store.flush()
+        helpers.forget_credentials()
     except storm.exceptions.IntegrityError:
         # E-mail already in database.
         raise helpers.BadRequest(errors.EXISTING_USER,
@@ -105,6 +119,7 @@ def update_user_password(user, uid):
         raise helpers.BadRequest(errors.INVALID_EMAIL,
                 "password is not satisfactory")
     user.password = password.encrypt(pw)
+    helpers.forget_credentials()
     return helpers.success()
 
 
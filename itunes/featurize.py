@@ -3,6 +3,7 @@
 import argparse
 import json
 import libunison.utils as uutils
+import numpy as np
 
 from db import *
 from storm.expr import Eq, Ne
@@ -12,24 +13,24 @@ DEFAULT_DB = 'gen/itunes.db'
 
 
 def fill_features(store):
-    conn = uutils.get_feature_db()
-    @uutils.memo
-    def tag_fct(tag):
-        return uutils.tag_features(tag, conn=conn, normalize=True)
+    space = uutils.get_tag_space().normalized()
+    tracks = list()
     for track in store.find(Track, Ne(Track.tags, None)
             & Eq(Track.features, None)):
-        print "Processing %s - %s ..." % (track.artist, track.title)
         if isinstance(track.tags, basestring):
             continue
-        features = uutils.track_features(
-                track.tags, conn=conn, tag_fct=tag_fct)
-        if features is None:
+        tracks.append(track)
+    # Embed all the tracks in one go.
+    batch = space.track_features_batch([track.tags for track in tracks])
+    for track, features in zip(tracks, batch):
+        print "Processing %s - %s ..." % (track.artist, track.title)
+        if np.isnan(features[0]):
             # The track probably didn't have any tags.
             print "-- Feature vector is null."
             continue
         # Serialize and save the feature vector.
         track.features = uutils.encode_features(features)
-        store.commit()
+    store.commit()
 
 
 def _parse_args():
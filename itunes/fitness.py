@@ -3,7 +3,6 @@
 import argparse
 import json
 import libunison.utils as uutils
-import numpy as np
 import matplotlib.pyplot as plt
 import operator
 import os.path
@@ -19,14 +18,11 @@ DEFAULT_DB = 'gen/itunes.db'
 
 
 def process(user):
-    tracks = list()
-    for track in user.tracks:
-        if track.features is not None:
-            features = uutils.decode_features(track.features.encode('utf-8'))
-            tracks.append([5*x for x in features])
+    tracks = 5 * uutils.decode_features_batch([track.features.encode('utf-8')
+            for track in user.tracks if track.features is not None])
     for dim in range(2, 16) + [20, 25, 30, 40]:
         for k in range(1, 21):
-            pts = np.array([x[:dim] for x in tracks])
+            pts = tracks[:, :dim]
             clf = mixture.GMM(n_components=k, covariance_type='full')
             clf.fit(pts)
             print ("dim = %d, k = %d, cov = full, bic = %f, aic = %f, n = %d"
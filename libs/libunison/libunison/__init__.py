@@ -1 +1,3 @@
-__all__ = ["utils", "models", "password", "mail", "geometry", "predict"]
+__all__ = ["utils", "models", "password", "mail", "geometry", "predict",
+        "training", "library", "pool",
+        "messaging"]
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
-import re
 import geometry
+import numpy as np
+import re
 
 from storm.variables import Variable
 from storm.properties import SimpleProperty
@@ -40,3 +41,32 @@ class PointVariable(Variable):
 
 class Point(SimpleProperty):
     variable_class = PointVariable
+
+
+class FeaturesVariable(Variable):
+    """Feature vector stored as a raw array of little-endian 4-byte floats.
+
+    The variable internally holds the raw bytes; getting the value returns a
+    (read-only) float32 NumPy array that shares the memory of these bytes.
+    """
+    DTYPE = np.dtype('<f4')
+    __slots__ = ()
+
+    def parse_set(self, value, from_db):
+        if from_db:
+            if not isinstance(value, (str, buffer)):
+                raise TypeError("Expected bytes, found %s" % repr(value))
+            return str(value)
+        try:
+            return np.asarray(value, dtype=self.DTYPE).ravel().tobytes()
+        except (TypeError, ValueError):
+            raise TypeError("Expected features, found %s" % repr(value))
+
+    def parse_get(self, value, to_db):
+        if to_db:
+            return value
+        return np.frombuffer(value, dtype=self.DTYPE)
+
+
+class Features(SimpleProperty):
+    variable_class = FeaturesVariable
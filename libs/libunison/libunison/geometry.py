@@ -2,13 +2,21 @@
 """Geometrical stuff."""
 
 import collections
+import numpy as np
+import scipy.spatial
+import threading
 
-from math import atan2, cos, pi, sin, sqrt
+from math import asin, atan2, cos, pi, sin, sqrt
 
 # Mean earth radius in meters, according to
 # http://en.wikipedia.org/wiki/Earth_radius#Mean_radius
 EARTH_RADIUS = 6371009
 
+DEG_TO_RAD = pi / 180
+
+
+# Nb. of pending changes after which a spatial index is rebuilt.
+REBUILD_THRESHOLD = 64
 
 # Simple data structure to represent a point.
 Point = collections.namedtuple('Point', 'lat lon')
@@ -33,4 +41,163 @@ def distance(a, b, radius=EARTH_RADIUS):
 
 def deg_to_rad(angle):
     """Convert an angle from degree to radians."""
-    return (2 * pi / 360) * angle
+    return DEG_TO_RAD * angle
+
+
+def distances(origin, lats, lons, radius=EARTH_RADIUS):
+    """Compute the great-circle distances from a point to many points.
+
+    Same as `distance`, but the destinations are given as arrays of latitudes
+    and longitudes (in degrees). Returns an array of distances in meters.
+    """
+    return PointSet(lats, lons).distances(origin, radius)
+
+
+def distance_matrix(lats, lons, other_lats=None, other_lons=None,
+        radius=EARTH_RADIUS):
+    """Compute the pairwise great-circle distances between two sets of points.
+
+    Returns a matrix whose entry (i, j) is the distance between the i-th point
+    of the first set and the j-th point of the second set. If the second set is
+    omitted, the distances within the first set are computed.
+    """
+    first = PointSet(lats, lons)
+    second = (PointSet(other_lats, other_lons)
+            if other_lats is not None else first)
+    return first.distance_matrix(second, radius)
+
+
+class PointSet(object):
+    """Set of points with precomputed radians and cosines.
+
+    Useful for points that don't move (e.g. the groups' locations) and that
+    are compared to many other points.
+    """
+
+    def __init__(self, lats, lons):
+        self.lats = np.asarray(lats, dtype=np.float64) * DEG_TO_RAD
+        self.lons = np.asarray(lons, dtype=np.float64) * DEG_TO_RAD
+        self.cos_lats = np.cos(self.lats)
+
+    @classmethod
+    def from_points(cls, points):
+        return cls([p.lat for p in points], [p.lon for p in points])
+
+    def __len__(self):
+        return len(self.lats)
+
+    def distances(self, origin, radius=EARTH_RADIUS):
+        """Compute the distances (in meters) from a point to the set."""
+        lat = deg_to_rad(origin.lat)
+        lon = deg_to_rad(origin.lon)
+        return _haversine(lat, lon, cos(lat),
+                self.lats, self.lons, self.cos_lats, radius)
+
+    def distance_matrix(self, other, radius=EARTH_RADIUS):
+        """Compute the pairwise distances (in meters) to another set."""
+        return _haversine(self.lats[:, np.newaxis], self.lons[:, np.newaxis],
+                self.cos_lats[:, np.newaxis],
+                other.lats, other.lons, other.cos_lats, radius)
+
+    def to_vectors(self):
+        """Map the points to 3D vectors on the unit sphere."""
+        return np.column_stack((self.cos_lats * np.cos(self.lons),
+                self.cos_lats * np.sin(self.lons), np.sin(self.lats)))
+
+
+def _haversine(a_lat, a_lon, a_cos, b_lat, b_lon, b_cos, radius):
+    """Vectorized haversine formula, on angles in radians."""
+    x = (np.sin((b_lat - a_lat) / 2.0)**2
+            + np.sin((b_lon - a_lon) / 2.0)**2 * a_cos * b_cos)
+    # Guard against rounding errors pushing x out of [0, 1].
+    x = np.clip(x, 0.0, 1.0)
+    return radius * 2 * np.arctan2(np.sqrt(x), np.sqrt(1 - x))
+
+
+def to_vector(point):
+    """Map a point (in degrees) to a 3D vector on the unit sphere."""
+    lat = deg_to_rad(point.lat)
+    lon = deg_to_rad(point.lon)
+    return (cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat))
+
+
+def chord_to_distance(chord, radius=EARTH_RADIUS):
+    """Convert the length of a chord of the unit sphere to a distance."""
+    return radius * 2 * asin(min(chord / 2.0, 1.0))
+
+
+class SpatialIndex(object):
+    """Nearest-neighbour index over points on the earth.
+
+    The points are mapped to the unit sphere and stored in a k-d tree, where
+    the euclidean distance (chord length) is monotonic in the great-circle
+    distance. Points can be added, moved or removed; the changes are kept on the
+    side and the tree is rebuilt once there are too many of them. The index is
+    thread-safe.
+    """
+
+    def __init__(self, items=()):
+        self._lock = threading.RLock()
+        self._points = dict(items)  # Maps keys to points.
+        self._rebuild()
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def add(self, key, point):
+        """Add a point to the index (or move it if it exists already)."""
+        with self._lock:
+            self._points[key] = point
+            self._added[key] = point
+            self._changed()
+
+    def move(self, key, point):
+        self.add(key, point)
+
+    def remove(self, key):
+        with self._lock:
+            if self._points.pop(key, None) is not None:
+                self._added.pop(key, None)
+                self._changed()
+
+    def nearest(self, point, k):
+        """Find the k nearest points.
+
+        Returns a list of (key, distance) pairs, sorted by increasing distance
+        (in meters).
+        """
+        with self._lock:
+            if k <= 0 or len(self._points) == 0:
+                return []
+            vector = to_vector(point)
+            candidates = dict()
+            if len(self._keys) > 0:
+                # Query a few more points in case some of them are outdated.
+                nb = min(k + self._nb_changes, len(self._keys))
+                chords, indices = self._tree.query(vector, nb)
+                for chord, i in zip(np.atleast_1d(chords),
+                        np.atleast_1d(indices)):
+                    key = self._keys[i]
+                    if key in self._points and key not in self._added:
+                        candidates[key] = chord
+            for key, other in self._added.iteritems():
+                candidates[key] = np.linalg.norm(
+                        np.subtract(to_vector(other), vector))
+            best = sorted(candidates.iteritems(), key=lambda x: x[1])[:k]
+            return [(key, chord_to_distance(chord)) for key, chord in best]
+
+    def _changed(self):
+        self._nb_changes += 1
+        if self._nb_changes > REBUILD_THRESHOLD:
+            self._rebuild()
+
+    def _rebuild(self):
+        self._keys = list(self._points.keys())
+        points = PointSet.from_points([self._points[k] for k in self._keys])
+        self._tree = (scipy.spatial.cKDTree(points.to_vectors())
+                if len(points) > 0 else None)
+        self._added = dict()
+        self._nb_changes = 0
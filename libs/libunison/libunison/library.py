@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""Bulk access to the users' libraries.
+
+Going through the ORM to read a library issues one query per track (every
+`entry.track` is a separate lookup). The functions in this module read what
+they need with a single JOIN query instead. Similarly, libraries are updated
+with a few set-based statements (see LibrarySync).
+"""
+
+import itertools
+import numpy as np
+
+from _storm_ext import FeaturesVariable
+from models import Track
+from storm.exceptions import IntegrityError
+
+
+# Number of rows fetched at once when streaming results.
+BATCH_SIZE = 1000
+
+QUERY_LIBRARY = """
+    SELECT l.id, l.local_id, t.id, t.artist, t.title, t.raw_features
+    FROM lib_entry l JOIN track t ON t.id = l.track_id
+    WHERE l.user_id = ? AND l.valid AND l."local"
+    """
+
+QUERY_PLAYED = """
+    SELECT DISTINCT track_id FROM group_event
+    WHERE group_id = ? AND event_type = 'play' AND creation_time > ?
+        AND track_id IS NOT NULL
+    """
+
+# Number of rows inserted at once into the staging table.
+INSERT_BATCH_SIZE = 500
+
+# Nb. of times the creation of new tracks is attempted, when it collides with
+# concurrent uploads.
+MAX_TRACK_RETRIES = 5
+
+QUERY_CREATE_TRACK = """
+    INSERT INTO track (artist, title)
+    SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM track t
+        WHERE t.artist = ? AND t.title = ?)
+    RETURNING id"""
+
+QUERY_CREATE_TRACKS = """
+    INSERT INTO track (artist, title)
+    SELECT s.artist, s.title FROM lib_sync s
+    WHERE NOT EXISTS (SELECT 1 FROM track t
+        WHERE t.artist = s.artist AND t.title = s.title)
+    RETURNING id, artist, title"""
+
+# Used to give unique names to the server-side cursors.
+_cursor_ids = itertools.count()
+
+
+def iter_library(store, user_id, stream=False, batch_size=BATCH_SIZE):
+    """Iterate over the valid local entries of a user's library.
+
+    Yields (lib_entry_id, local_id, track_id, artist, title, features) tuples,
+    where features is a NumPy array (or None if the track has no features).
+    The whole library is read with one query. If `stream` is true, the rows
+    are fetched in batches through a server-side cursor, which keeps the
+    memory usage flat for very large libraries.
+    """
+    if stream:
+        rows = _stream(store, QUERY_LIBRARY, (user_id,), batch_size)
+    else:
+        rows = store.execute(QUERY_LIBRARY, (user_id,))
+    for entry_id, local_id, track_id, artist, title, raw in rows:
+        yield (entry_id, local_id, track_id, artist, title, _features(raw))
+
+
+def played_tracks(store, group_id, since):
+    """Get the set of IDs of the tracks played in a group since a given time.
+
+    Only the track IDs stored alongside the play events are read, the payloads
+    are left untouched.
+    """
+    rows = store.execute(QUERY_PLAYED, (group_id, since))
+    return set(track_id for (track_id,) in rows)
+
+
+def get_or_create_track(store, artist, title):
+    """Get a track, and create it if it is not in the database yet.
+
+    Returns a (track, created) pair. Unlike adding a Track object to the store,
+    this doesn't fail if another transaction creates the same track at the
+    same time.
+    """
+    rows = _create_tracks(store, QUERY_CREATE_TRACK,
+            (artist, title, artist, title))
+    track = store.find(Track, (Track.artist == artist)
+            & (Track.title == title)).one()
+    return track, len(rows) > 0
+
+
+class LibrarySync(object):
+    """Bulk update of a user's local library.
+
+    Entries are staged in a temporary table (see `add`), and the library is
+    then brought in sync with them in a handful of statements (see `apply`).
+    The outcome is the same as setting the entries one by one:
+
+    - entries that are already in the library are left untouched
+    - non-local entries for the same track are made local
+    - other entries for the same track are invalidated and replaced
+    - tracks that are not in the database yet are created
+
+    The staging table only lives until the end of the transaction.
+    """
+
+    def __init__(self, store, user_id):
+        self._store = store
+        self._user_id = user_id
+        self._store.execute("""
+            CREATE TEMPORARY TABLE lib_sync (
+              pos         serial,
+              artist      text NOT NULL,
+              title       text NOT NULL,
+              local_id    integer,
+              track_id    bigint,
+              pending     boolean NOT NULL DEFAULT TRUE,
+              make_local  boolean NOT NULL DEFAULT FALSE
+            ) ON COMMIT DROP""", noresult=True)
+
+    def add(self, entries):
+        """Stage (artist, title, local_id) entries."""
+        entries = list(entries)
+        for i in xrange(0, len(entries), INSERT_BATCH_SIZE):
+            batch = entries[i:i+INSERT_BATCH_SIZE]
+            values = ", ".join(["(?, ?, ?)"] * len(batch))
+            params = list(itertools.chain.from_iterable(batch))
+            self._store.execute("INSERT INTO lib_sync (artist, title, "
+                    "local_id) VALUES %s" % values, params, noresult=True)
+
+    def apply(self, invalidate_missing=True):
+        """Apply the staged entries to the library.
+
+        If `invalidate_missing` is true, the local entries that were not
+        staged are invalidated (i.e. the staged entries are the whole
+        library). Returns the number of entries that changed, and a list of
+        (id, artist, title) tuples for the tracks that were created.
+        """
+        execute = self._store.execute
+        uid = self._user_id
+        # If a track appears more than once, the last entry wins.
+        execute("""
+            DELETE FROM lib_sync s USING lib_sync o
+            WHERE o.artist = s.artist AND o.title = s.title AND o.pos > s.pos
+            """, noresult=True)
+        new_tracks = _create_tracks(self._store, QUERY_CREATE_TRACKS)
+        execute("""
+            UPDATE lib_sync s SET track_id = t.id FROM track t
+            WHERE t.artist = s.artist AND t.title = s.title
+            """, noresult=True)
+        # Entries that are already in the library.
+        execute("""
+            UPDATE lib_sync s SET pending = FALSE FROM lib_entry l
+            WHERE l.user_id = ? AND l.valid AND l."local"
+                AND l.track_id = s.track_id AND l.local_id = s.local_id
+            """, (uid,), noresult=True)
+        # Non-local entries are simply made local.
+        execute("""
+            UPDATE lib_sync s SET make_local = TRUE FROM lib_entry l
+            WHERE s.pending AND l.user_id = ? AND l.valid AND NOT l."local"
+                AND l.track_id = s.track_id
+            """, (uid,), noresult=True)
+        execute("""
+            UPDATE lib_entry l SET "local" = TRUE, local_id = s.local_id
+            FROM lib_sync s
+            WHERE s.make_local AND l.user_id = ? AND l.valid
+                AND NOT l."local" AND l.track_id = s.track_id
+            """, (uid,), noresult=True)
+        # Other entries are invalidated and replaced.
+        execute("""
+            UPDATE lib_entry l SET valid = FALSE FROM lib_sync s
+            WHERE s.pending AND NOT s.make_local AND l.user_id = ?
+                AND l.valid AND l.track_id = s.track_id
+            """, (uid,), noresult=True)
+        execute("""
+            INSERT INTO lib_entry (user_id, track_id, local_id, valid, "local")
+            SELECT ?, s.track_id, s.local_id, TRUE, TRUE FROM lib_sync s
+            WHERE s.pending AND NOT s.make_local
+            """, (uid,), noresult=True)
+        changed = execute(
+                "SELECT count(*) FROM lib_sync WHERE pending").get_one()[0]
+        if invalidate_missing:
+            changed += execute("""
+                UPDATE lib_entry l SET valid = FALSE
+                WHERE l.user_id = ? AND l.valid AND l."local"
+                    AND NOT EXISTS (SELECT 1 FROM lib_sync s
+                        WHERE s.track_id = l.track_id
+                            AND s.local_id = l.local_id)
+                """, (uid,)).rowcount
+        execute("DROP TABLE lib_sync", noresult=True)
+        # The objects cached by the store might be outdated.
+        self._store.invalidate()
+        return changed, new_tracks
+
+
+def _create_tracks(store, query, params=None):
+    """Run an INSERT INTO track ... WHERE NOT EXISTS statement.
+
+    Another transaction might be creating some of the same tracks at the same
+    time. The insert then waits for it, and fails on the unique constraint if
+    it commits; the statement is rolled back (to a savepoint) and run again,
+    which now skips the tracks that were created. Returns the inserted rows.
+    """
+    for attempt in xrange(MAX_TRACK_RETRIES):
+        store.execute("SAVEPOINT create_tracks", noresult=True)
+        try:
+            rows = store.execute(query, params).get_all()
+        except IntegrityError:
+            store.execute("ROLLBACK TO SAVEPOINT create_tracks", noresult=True)
+            if attempt == MAX_TRACK_RETRIES - 1:
+                raise
+        else:
+            store.execute("RELEASE SAVEPOINT create_tracks", noresult=True)
+            return rows
+
+
+def _stream(store, query, params, batch_size):
+    """Execute a query and fetch the results using a server-side cursor.
+
+    The cursor lives in the current transaction.
+    """
+    name = 'unison_cursor_%d' % next(_cursor_ids)
+    store.execute('DECLARE %s NO SCROLL CURSOR FOR %s' % (name, query),
+            params, noresult=True)
+    try:
+        while True:
+            rows = store.execute('FETCH FORWARD %d FROM %s'
+                    % (batch_size, name)).get_all()
+            if len(rows) == 0:
+                break
+            for row in rows:
+                yield row
+    finally:
+        store.execute('CLOSE %s' % name, noresult=True)
+
+
+def _features(raw):
+    """Get a feature vector from its binary form."""
+    if raw is not None:
+        return np.frombuffer(str(raw), dtype=FeaturesVariable.DTYPE)
+    return None
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""Publishing of jobs to the message queue.
+
+Opening a connection to RabbitMQ for every message is expensive. Instead, a
+publisher keeps a persistent channel open (per process) and messages can be
+collected during a request and sent at once at the end (see MessageBatch).
+For tests, the messages can be kept in memory instead of being sent.
+"""
+
+import json
+import pika
+import threading
+import utils
+
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
+
+
+ACTION_TAGS = 'track-tags'
+ACTION_INFO = 'track-info'
+
+# Identical messages published within this interval are dropped.
+DEDUP_TTL = 60 * 60  # In seconds.
+DEDUP_SIZE = 100000
+
+_publishers = dict()
+_publishers_lock = threading.Lock()
+
+
+class PublishError(Exception):
+    """Raised when the broker refuses a message."""
+    pass
+
+
+class Publisher(object):
+    """Publishes messages to a durable queue over a persistent channel.
+
+    If `confirm` is true, publisher confirms are enabled and every message is
+    acknowledged by the broker before `publish` returns. The publisher is
+    thread-safe, and reconnects if the connection was lost.
+    """
+
+    def __init__(self, host, queue, confirm=True):
+        self._host = host
+        self._queue = queue
+        self._confirm = confirm
+        self._lock = threading.Lock()
+        self._conn = None
+        self._channel = None
+
+    def publish(self, body):
+        self.publish_many([body])
+
+    def publish_many(self, bodies):
+        """Publish a list of messages over the channel."""
+        with self._lock:
+            try:
+                self._publish(bodies)
+            except (AMQPConnectionError, AMQPChannelError):
+                # The connection might have been closed in the meantime.
+                self._reset()
+                self._publish(bodies)
+
+    def close(self):
+        with self._lock:
+            self._reset()
+
+    def _publish(self, bodies):
+        if self._channel is None:
+            self._connect()
+        for body in bodies:
+            ok = self._channel.basic_publish(exchange='',
+                    routing_key=self._queue, body=body,
+                    properties=pika.BasicProperties(delivery_mode=2))
+            # With confirms enabled, False means that the broker refused (or
+            # couldn't route) the message (requires pika >= 0.10).
+            if not ok:
+                raise PublishError("message was not confirmed: %r" % body)
+
+    def _connect(self):
+        self._conn = pika.BlockingConnection(
+                pika.ConnectionParameters(self._host))
+        self._channel = self._conn.channel()
+        # Creates the queue if it doesn't exist yet.
+        self._channel.queue_declare(queue=self._queue, durable=True)
+        if self._confirm:
+            self._channel.confirm_delivery()
+
+    def _reset(self):
+        conn, self._conn, self._channel = self._conn, None, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+class MemoryPublisher(object):
+    """Stand-in for the publisher that keeps the messages in memory."""
+
+    def __init__(self):
+        self.messages = list()
+        self._lock = threading.Lock()
+
+    def publish(self, body):
+        self.publish_many([body])
+
+    def publish_many(self, bodies):
+        with self._lock:
+            self.messages.extend(bodies)
+
+    def close(self):
+        pass
+
+
+class DedupPublisher(object):
+    """Wrapper around a publisher that drops duplicate messages.
+
+    A message is dropped if an identical message was published less than `ttl`
+    seconds ago (by this process). Messages are remembered only once they have
+    been published successfully.
+    """
+
+    def __init__(self, publisher, ttl=DEDUP_TTL, max_size=DEDUP_SIZE):
+        self._publisher = publisher
+        self._recent = utils.LRUCache(max_size, ttl=ttl)
+
+    def publish(self, body):
+        self.publish_many([body])
+
+    def publish_many(self, bodies):
+        fresh = list()
+        seen = set()
+        for body in bodies:
+            if body not in seen and self._recent.get(body) is None:
+                fresh.append(body)
+            seen.add(body)
+        if len(fresh) == 0:
+            return
+        self._publisher.publish_many(fresh)
+        for body in fresh:
+            self._recent.put(body, True)
+
+    def close(self):
+        self._publisher.close()
+
+
+class MessageBatch(object):
+    """Messages collected and sent at once (e.g. at the end of a request)."""
+
+    def __init__(self, publisher):
+        self._publisher = publisher
+        self._bodies = list()
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def add(self, body):
+        self._bodies.append(body)
+
+    def extend(self, bodies):
+        self._bodies.extend(bodies)
+
+    def flush(self):
+        """Send the messages collected so far."""
+        bodies, self._bodies = self._bodies, list()
+        if len(bodies) > 0:
+            self._publisher.publish_many(bodies)
+
+    def discard(self):
+        self._bodies = list()
+
+
+def track_jobs(artist, title):
+    """Get the jobs that fetch the tags and other information of a track."""
+    meta = {'artist': artist, 'title': title}
+    return [
+      json.dumps({'action': ACTION_TAGS, 'track': meta}),
+      json.dumps({'action': ACTION_INFO, 'track': meta}),
+    ]
+
+
+def get_publisher(config, section='queue', dedup_ttl=DEDUP_TTL):
+    """Get the (shared) publisher for the queue described by the config.
+
+    `section` is the key of the queue's configuration. Setting `backend:
+    memory` in there keeps the messages in memory instead of sending them.
+    Duplicate messages are dropped, unless `dedup_ttl` is set to 0 (in the
+    configuration, or as the default for the section).
+    """
+    options = config[section]
+    backend = options.get('backend', 'amqp')
+    key = (backend, options.get('host'), options.get('name'))
+    with _publishers_lock:
+        if key not in _publishers:
+            if backend == 'memory':
+                publisher = MemoryPublisher()
+            else:
+                publisher = Publisher(options['host'], options['name'],
+                        confirm=options.get('confirm', True))
+            ttl = options.get('dedup_ttl', dedup_ttl)
+            if ttl > 0:
+                publisher = DedupPublisher(publisher, ttl=ttl)
+            _publishers[key] = publisher
+        return _publishers[key]
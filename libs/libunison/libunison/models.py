@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 from storm.locals import *
-from _storm_ext import Point
+from _storm_ext import Point, Features
 
 
 class User(Storm):
@@ -50,7 +50,7 @@ class Track(Storm):
     image = Unicode()
     listeners = Int()
     tags = Unicode()
-    features = Unicode()
+    raw_features = Features()
     # Relationships
     lib_entries = ReferenceSet(id, 'LibEntry.track_id')
 
@@ -95,10 +95,12 @@ class GroupEvent(Storm):
       u'skip': u'skip',
       u'master': u'master',
     })
+    track_id = Int()
     payload = JSON()
     # Relationships
     user = Reference(user_id, 'User.id')
     group = Reference(group_id, 'Group.id')
+    track = Reference(track_id, 'Track.id')
 
     def __init__(self, group, user, event_type, payload=None):
         self.group = group
@@ -7,6 +7,12 @@ import os
 
 from pbkdf2 import PBKDF2
 
+try:
+    # Native implementation, available from Python 2.7.8 on.
+    from hashlib import pbkdf2_hmac
+except ImportError:
+    pbkdf2_hmac = None
+
 
 NB_ITERATIONS = 1000
 HASH_LENGTH = 16  # In bytes.
@@ -18,14 +24,22 @@ def encrypt(password, key=None):
     assert isinstance(password, unicode)
     if key is None:
         key = os.urandom(HASH_LENGTH)
-    mac = PBKDF2(password.decode('utf-8'), key, iterations=NB_ITERATIONS,
-            digestmodule=HASH_FUNCTION).read(HASH_LENGTH)
+    mac = derive(password.encode('utf-8'), key)
     return u":".join([
       base64.b64encode(key),
       base64.b64encode(mac)
     ])
 
 
+def derive(secret, key):
+    """Derive the raw hash of a byte string (PBKDF2-HMAC-SHA256)."""
+    if pbkdf2_hmac is not None:
+        return pbkdf2_hmac(HASH_FUNCTION().name, secret, key, NB_ITERATIONS,
+                HASH_LENGTH)
+    return PBKDF2(secret, key, iterations=NB_ITERATIONS,
+            digestmodule=HASH_FUNCTION).read(HASH_LENGTH)
+
+
 def verify(password, encrypted):
    key, mac = encrypted.split(':')
    raw_key = base64.b64decode(key)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""Pooling of the database connections for the web apps.
+
+Opening a connection to PostgreSQL is a large fixed cost compared to the work
+done by most requests. Instead of creating (and closing) a store for every
+request, the stores are kept in a pool and reused.
+"""
+
+import Queue
+import os
+import storm.locals
+import threading
+import time
+import utils
+
+
+# Maximal number of idle stores kept in a pool.
+DEFAULT_SIZE = 5
+
+# Stores idle for longer than this are checked before being reused.
+DEFAULT_CHECK_AFTER = 30  # In seconds.
+
+# Interval between two checks of the configuration file's modification time.
+RELOAD_CHECK_INTERVAL = 5  # In seconds.
+
+
+class StorePool(object):
+    """Thread-safe pool of Storm stores.
+
+    At most `size` idle stores are kept. When the pool is empty, new stores are
+    created on demand, so getting a store never blocks.
+    """
+
+    def __init__(self, conn_str, size=DEFAULT_SIZE,
+            check_after=DEFAULT_CHECK_AFTER):
+        self._database = storm.locals.create_database(conn_str)
+        self._check_after = check_after
+        self._idle = Queue.LifoQueue(maxsize=size)
+        self._closed = False
+
+    def get(self):
+        """Get a store that is ready to be used."""
+        while True:
+            try:
+                store, since = self._idle.get_nowait()
+            except Queue.Empty:
+                return storm.locals.Store(self._database)
+            if (time.time() - since < self._check_after
+                    or self._is_healthy(store)):
+                return store
+            _close(store)
+
+    def put(self, store):
+        """Give a store back to the pool.
+
+        Whatever is left of the current transaction is rolled back.
+        """
+        try:
+            store.rollback()
+            # Don't serve stale objects to the next user of the store.
+            store.reset()
+        except Exception:
+            _close(store)
+            return
+        if self._closed:
+            _close(store)
+            return
+        try:
+            self._idle.put_nowait((store, time.time()))
+        except Queue.Full:
+            _close(store)
+
+    def close(self):
+        """Close the idle stores. Stores given back later are closed too."""
+        self._closed = True
+        while True:
+            try:
+                store, since = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            _close(store)
+
+    def _is_healthy(self, store):
+        try:
+            store.execute('SELECT 1')
+            store.rollback()
+            return True
+        except Exception:
+            return False
+
+
+class AppState(object):
+    """Configuration and store pool shared by the requests of a web app.
+
+    The configuration is read once, and read again when the file is modified
+    (its modification time is checked every RELOAD_CHECK_INTERVAL seconds) or
+    when a reload is requested. The pool is rebuilt if the database settings
+    changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None
+        self._mtime = None
+        self._checked = 0
+        self._reload = False
+        self.config = None
+        self.pool = None
+
+    def setup(self, path=None):
+        """Load the configuration if needed, and return the state."""
+        with self._lock:
+            self._path = path or self._path
+            now = time.time()
+            if now - self._checked >= RELOAD_CHECK_INTERVAL:
+                self._checked = now
+                if self._get_mtime() != self._mtime:
+                    self._reload = True
+            if self.config is None or self._reload:
+                self._load()
+        return self
+
+    def request_reload(self):
+        """Read the configuration again when the next request comes in."""
+        self._reload = True
+
+    def _get_mtime(self):
+        try:
+            return os.stat(self._path).st_mtime
+        except (OSError, TypeError):
+            return None
+
+    def _load(self):
+        # Read the modification time first, so that a concurrent change of
+        # the file is picked up by the next check.
+        self._mtime = self._get_mtime()
+        config = utils.load_config(self._path)
+        db = config['database']
+        old = self.config['database'] if self.config is not None else None
+        if self.pool is None or db != old:
+            if self.pool is not None:
+                self.pool.close()
+            self.pool = StorePool(db['string'],
+                    size=db.get('pool_size', DEFAULT_SIZE),
+                    check_after=db.get('check_after', DEFAULT_CHECK_AFTER))
+        self.config = config
+        self._reload = False
+
+
+def _close(store):
+    try:
+        store.close()
+    except Exception:
+        pass
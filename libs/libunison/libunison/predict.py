@@ -1,51 +1,115 @@
 #!/usr/bin/env python
 
+import hashlib
+import library
 import numpy as np
 import sklearn.mixture
 import utils
 import math
+import multiprocessing
 import pickle
+import struct
 
 from operator import itemgetter, mul
-from models import *
 
 
 DIMENSIONS = 5
 SCALE = 5
 
+# Number of points scored at once by the vectorized scoring functions.
+SCORE_CHUNK_SIZE = 2048
+
+# Maximal number of user models kept in memory by the process.
+MODEL_CACHE_SIZE = 1000
+
+# Process-wide cache of the unserialized models, keyed by user ID. Each value
+# is a (digest, model) pair, where the digest identifies the serialized model.
+_model_cache = utils.LRUCache(MODEL_CACHE_SIZE)
+
 
 class Model(object):
 
     K_MAX = 10
     MIN_COVAR = 0.001
+    # Maximal fraction of points added or removed for incremental updates.
+    REFIT_THRESHOLD = 0.1
+    # Number of EM iterations when warm-starting from the previous model.
+    REFIT_ITERATIONS = 10
 
     def __init__(self, user):
         self._user = user
-        if user.model is not None:
-            self._gmm = pickle.loads(user.model.encode('utf-8'))
-        else:
-            self._gmm = None
+        self._gmm = load_model(user)
+
+    def generate(self, store, incremental=False, changed=None,
+            selector=None):
+        """Fit a new model to the user's library.
 
-    def generate(self, store):
+        By default, GMMs with up to K_MAX components are fitted from scratch
+        and the best one is selected using the BIC. In incremental mode, if the
+        library changed only slightly since the last full selection (at most
+        REFIT_THRESHOLD of the points were added or removed, accumulated over
+        the updates), EM is instead warm-started from the current model's
+        components. The number of changed points can be given explicitly; it is
+        estimated otherwise.
+
+        A ModelSelector can be given to control how the candidates are fitted
+        (e.g. in parallel).
+        """
         points = get_points(self._user, store)
         k_max = min(self.K_MAX, len(points) / (2 * DIMENSIONS))
         if k_max < 1:
             self._user.model = None
             self._gmm = None
+            _model_cache.pop(self._user.id)
             return
-        candidates = list()
-        for k in range(1, k_max+1):
-            gmm = sklearn.mixture.GMM(n_components=k, covariance_type='full',
-                    min_covar=self.MIN_COVAR)
-            gmm.fit(points)
-            candidates.append((gmm, gmm.bic(points)))
-        self._gmm, bic = min(candidates, key=itemgetter(1))
-        self._user.model = unicode(pickle.dumps(self._gmm))
+        total = self._changes_since_selection(points, k_max, changed)
+        if (incremental and total is not None
+                and total <= self.REFIT_THRESHOLD * self._gmm.n_samples):
+            gmm = self._refit(points)
+            # Keep measuring the changes against the last full selection.
+            self._gmm = GaussianMixture.from_sklearn(gmm,
+                    self._gmm.n_samples, total)
+        else:
+            if selector is None:
+                selector = ModelSelector()
+            gmm = selector.select(points, k_max, self.MIN_COVAR)
+            self._gmm = GaussianMixture.from_sklearn(gmm, len(points))
+        self._user.model = self._gmm.serialize()
         store.flush()
+        # Replace the cached model by the new one.
+        _model_cache.put(self._user.id,
+                (_model_digest(self._user.model), self._gmm))
+
+    def _changes_since_selection(self, points, k_max, changed):
+        """Estimate the nb. of points changed since the last full selection.
+
+        Returns None if the current model cannot be warm-started at all.
+        """
+        if (self._gmm is None or self._gmm.n_samples == 0
+                or self._gmm.n_components > k_max
+                or self._gmm.n_dimensions != points.shape[1]):
+            return None
+        # The net growth (or shrinkage) is a lower bound of the changes.
+        return max(self._gmm.n_changed + (changed or 0),
+                abs(len(points) - self._gmm.n_samples))
+
+    def _refit(self, points):
+        """Run a few EM iterations starting from the current model."""
+        gmm = sklearn.mixture.GMM(n_components=self._gmm.n_components,
+                covariance_type='full', min_covar=self.MIN_COVAR,
+                n_iter=self.REFIT_ITERATIONS, init_params='')
+        gmm.weights_ = self._gmm.weights
+        gmm.means_ = self._gmm.means
+        gmm.covars_ = self._gmm.covars()
+        gmm.fit(points)
+        return gmm
 
     def is_nontrivial(self):
         return self._gmm is not None
 
+    def get_mixture(self):
+        return self._gmm
+
     def get_nb_components(self):
         if not self.is_nontrivial():
             return 0
@@ -57,22 +121,257 @@ class Model(object):
         return [math.exp(x) for x in self._gmm.score(points)]
 
 
+class ModelSelector(object):
+    """Fit candidate GMMs and select the best one according to the BIC.
+
+    Candidates with an increasing number of components are fitted in batches
+    of `processes` models, in parallel if there is more than one process. If
+    `patience` is set, the sweep stops as soon as the BIC has risen for that
+    many consecutive values of k.
+    """
+
+    def __init__(self, processes=1, patience=None):
+        self._processes = processes
+        self._patience = patience
+        if processes > 1:
+            self._pool = multiprocessing.Pool(processes)
+        else:
+            self._pool = None
+
+    def select(self, points, k_max, min_covar):
+        candidates = list()
+        rises = 0
+        for start in xrange(1, k_max+1, self._processes):
+            stop = min(start + self._processes, k_max + 1)
+            jobs = [(points, k, min_covar) for k in xrange(start, stop)]
+            if self._pool is not None:
+                results = self._pool.map(_fit_candidate, jobs)
+            else:
+                results = map(_fit_candidate, jobs)
+            for gmm, bic in results:
+                if len(candidates) > 0 and bic > candidates[-1][1]:
+                    rises += 1
+                else:
+                    rises = 0
+                candidates.append((gmm, bic))
+                if self._patience is not None and rises >= self._patience:
+                    break
+            if self._patience is not None and rises >= self._patience:
+                break
+        gmm, bic = min(candidates, key=itemgetter(1))
+        return gmm
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+
+def _fit_candidate(job):
+    """Fit a GMM with k components, return it along with its BIC."""
+    points, k, min_covar = job
+    gmm = sklearn.mixture.GMM(n_components=k, covariance_type='full',
+            min_covar=min_covar)
+    gmm.fit(points)
+    return gmm, gmm.bic(points)
+
+
+class GaussianMixture(object):
+    """Lightweight Gaussian mixture model with full covariances.
+
+    The model is described by its component weights, means and by the
+    Cholesky factors of the precision matrices (upper triangular matrices U
+    such that U * U^T is the precision matrix). It knows how to score points
+    and how to (de)serialize itself to a compact textual representation.
+
+    `n_samples` is the number of points when the number of components was
+    last selected, and `n_changed` the number of points changed since then.
+
+    The serialized format is the PREFIX followed by base64 encoded data: a
+    small header (number of components, dimensions, n_samples and n_changed)
+    and the parameters as packed float32 arrays. Only the upper triangle of
+    the Cholesky factors is stored. Models in the previous format (without
+    n_changed) can still be read.
+    """
+
+    PREFIX = u'gmm2:'
+    HEADER = struct.Struct('<HHII')
+    OLD_PREFIX = u'gmm1:'
+    OLD_HEADER = struct.Struct('<HHI')
+    DTYPE = np.dtype('<f4')
+
+    def __init__(self, weights, means, prec_chol, n_samples=0, n_changed=0):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.means = np.asarray(means, dtype=np.float64)
+        self.prec_chol = np.asarray(prec_chol, dtype=np.float64)
+        self.n_samples = n_samples
+        self.n_changed = n_changed
+
+    @property
+    def n_components(self):
+        return len(self.weights)
+
+    @property
+    def n_dimensions(self):
+        return self.means.shape[1]
+
+    @classmethod
+    def from_sklearn(cls, gmm, n_samples=0, n_changed=0):
+        """Convert a fitted sklearn GMM with full covariances."""
+        prec_chol = list()
+        for covar in gmm.covars_:
+            cov_chol = np.linalg.cholesky(covar)
+            prec_chol.append(np.linalg.inv(cov_chol).T)
+        return cls(gmm.weights_, gmm.means_, prec_chol, n_samples, n_changed)
+
+    @classmethod
+    def is_serialized(cls, text):
+        """Check whether a text is a model in the compact format."""
+        return text.startswith(cls.PREFIX) or text.startswith(cls.OLD_PREFIX)
+
+    @classmethod
+    def deserialize(cls, text):
+        if text.startswith(cls.OLD_PREFIX):
+            raw = utils.b64dec(text[len(cls.OLD_PREFIX):])
+            k, dim, n_samples = cls.OLD_HEADER.unpack_from(raw)
+            n_changed = 0
+            offset = cls.OLD_HEADER.size
+        else:
+            raw = utils.b64dec(text[len(cls.PREFIX):])
+            k, dim, n_samples, n_changed = cls.HEADER.unpack_from(raw)
+            offset = cls.HEADER.size
+        data = np.frombuffer(raw, dtype=cls.DTYPE, offset=offset)
+        nb_tri = dim * (dim + 1) / 2
+        if len(data) != k * (1 + dim + nb_tri):
+            raise ValueError("model data is corrupted")
+        weights = data[:k]
+        means = data[k:k*(1+dim)].reshape(k, dim)
+        prec_chol = np.zeros((k, dim, dim))
+        rows, cols = np.triu_indices(dim)
+        prec_chol[:, rows, cols] = data[k*(1+dim):].reshape(k, nb_tri)
+        return cls(weights, means, prec_chol, n_samples, n_changed)
+
+    def serialize(self):
+        rows, cols = np.triu_indices(self.n_dimensions)
+        data = np.concatenate((self.weights, self.means.ravel(),
+                self.prec_chol[:, rows, cols].ravel()))
+        raw = (self.HEADER.pack(self.n_components, self.n_dimensions,
+                self.n_samples, self.n_changed)
+                + data.astype(self.DTYPE).tobytes())
+        return self.PREFIX + utils.b64enc(raw).decode('ascii')
+
+    def covars(self):
+        """Compute the covariance matrices of the components."""
+        return np.array([np.linalg.inv(np.dot(u, u.T))
+                for u in self.prec_chol])
+
+    def score(self, points):
+        """Compute the log-likelihood of each point under the model."""
+        return log_likelihoods([self], points)[0]
+
+
+def log_likelihoods(mixtures, points):
+    """Compute the log-likelihood of points under several mixtures at once.
+
+    The components of all the mixtures are stacked and evaluated in one pass.
+    Returns a (nb_mixtures, nb_points) matrix.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    weights = np.concatenate([m.weights for m in mixtures])
+    means = np.concatenate([m.means for m in mixtures])
+    prec_chol = np.concatenate([m.prec_chol for m in mixtures])
+    # Index of the first component of each mixture.
+    offsets = np.cumsum([0] + [m.n_components for m in mixtures[:-1]])
+    dim = means.shape[1]
+    log_det = np.log(np.diagonal(prec_chol, axis1=1, axis2=2)).sum(axis=1)
+    constant = np.log(weights) + log_det - 0.5 * dim * math.log(2 * math.pi)
+    result = np.empty((len(mixtures), len(points)))
+    # Process the points in chunks to bound the size of the temporaries.
+    for start in xrange(0, len(points), SCORE_CHUNK_SIZE):
+        chunk = points[start:start+SCORE_CHUNK_SIZE]
+        diff = chunk[np.newaxis, :, :] - means[:, np.newaxis, :]
+        y = np.einsum('cnd,cde->cne', diff, prec_chol)
+        log_probs = constant[:, np.newaxis] - 0.5 * (y * y).sum(axis=2)
+        # Sum the component likelihoods of each mixture.
+        result[:, start:start+SCORE_CHUNK_SIZE] = np.logaddexp.reduceat(
+                log_probs, offsets, axis=0)
+    return result
+
+
+def aggregate_log(matrix, mode='mult'):
+    """Aggregate the log-likelihoods of points for a group of users.
+
+    `matrix` has one row of log-likelihoods per user. The rows are summed in
+    the 'mult' mode (product of the likelihoods), and combined with logsumexp
+    in the 'add' mode (sum of the likelihoods). Returns the log of the
+    aggregated scores.
+    """
+    matrix = np.asarray(matrix)
+    if mode == 'mult':
+        return matrix.sum(axis=0)
+    elif mode == 'add':
+        return logsumexp(matrix, axis=0)
+    else:
+        raise ValueError('mode unknown')
+
+
+def logsumexp(values, axis=0):
+    """Compute log(sum(exp(values))) in a numerically stable way."""
+    values = np.asarray(values)
+    vmax = values.max(axis=axis)
+    vmax = np.where(np.isfinite(vmax), vmax, 0)
+    summed = np.exp(values - np.expand_dims(vmax, axis)).sum(axis=axis)
+    return np.log(summed) + vmax
+
+
+def load_model(user):
+    """Get the user's model as a GaussianMixture (or None if there is none).
+
+    Models are cached across calls, as long as the user's serialized model
+    stays the same.
+    """
+    if user.model is None:
+        return None
+    digest = _model_digest(user.model)
+    cached = _model_cache.get(user.id)
+    if cached is not None and cached[0] == digest:
+        return cached[1]
+    if GaussianMixture.is_serialized(user.model):
+        gmm = GaussianMixture.deserialize(user.model)
+    else:
+        # Legacy format: pickled sklearn GMM.
+        gmm = GaussianMixture.from_sklearn(
+                pickle.loads(user.model.encode('utf-8')))
+    _model_cache.put(user.id, (digest, gmm))
+    return gmm
+
+
+def _model_digest(model):
+    return hashlib.sha1(model.encode('utf-8')).digest()
+
+
 def get_points(user, store):
     points = list()
-    rows = store.find(LibEntry, (LibEntry.user == user)
-            & LibEntry.is_local & LibEntry.is_valid)
-    for row in rows:
-        point = get_point(row.track)
-        if point is not None:
-            points.append(point)
-    return np.array(points)
-
-
-def get_point(track):
-    if track.features is not None:
-        features = utils.decode_features(track.features)
-        return [x*SCALE for x in features[:DIMENSIONS]]
-    return None
+    for entry in library.iter_library(store, user.id):
+        features = entry[5]
+        if features is not None:
+            points.append(features[:DIMENSIONS])
+    return SCALE * np.array(points, dtype=np.float64)
+
+
+def top_k(scores, k):
+    """Get the indices of the k highest scores, by decreasing score.
+
+    Uses a partial selection, so that only the k selected scores are sorted.
+    """
+    scores = np.asarray(scores)
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    if k < len(scores):
+        indices = np.argpartition(-scores, k - 1)[:k]
+    else:
+        indices = np.arange(len(scores))
+    return indices[np.argsort(-scores[indices])]
 
 
 def aggregate(ratings, mode='mult'):
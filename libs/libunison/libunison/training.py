@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Background training of the users' models.
+
+Instead of fitting a user's model while handling a request, a job is put on a
+queue and processed by a pool of workers. Two queues are available: one backed
+by RabbitMQ (to feed separate worker processes), and an in-process stand-in
+that hands the jobs directly to a local pool of workers.
+"""
+
+import json
+import logging
+import messaging
+import multiprocessing
+import pika
+import predict
+import threading
+import utils
+
+from collections import deque
+from models import User
+
+
+ACTION = 'train-model'
+
+_local_queue = None
+_local_queue_lock = threading.Lock()
+
+
+class Trainer(object):
+    """Pool of worker threads that (re)generate user models.
+
+    Jobs for a user that is already waiting to be processed are coalesced into
+    a single job. A user is never processed by two workers at the same time.
+    """
+
+    def __init__(self, store_factory, nb_workers=1, incremental=True,
+            selector=None, logger=None):
+        self._store_factory = store_factory
+        self._nb_workers = nb_workers
+        self._incremental = incremental
+        self._selector = selector
+        self._logger = logger or logging.getLogger('trainer')
+        self._pending = dict()  # Maps user IDs to nb. of changes.
+        self._order = deque()  # Pending user IDs, in order of arrival.
+        self._running = set()
+        self._cond = threading.Condition()
+        self._threads = list()
+
+    def start(self):
+        """Start the worker threads."""
+        for i in xrange(self._nb_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, uid, changed=None):
+        """Schedule the generation of a user's model.
+
+        `changed` is the number of library entries that changed since the last
+        model was generated, if known.
+        """
+        with self._cond:
+            if uid in self._pending:
+                previous = self._pending[uid]
+                if previous is None or changed is None:
+                    changed = None
+                else:
+                    changed += previous
+            else:
+                self._order.append(uid)
+            self._pending[uid] = changed
+            self._cond.notify_all()
+
+    def join(self):
+        """Wait until all the scheduled jobs have been processed."""
+        with self._cond:
+            while len(self._pending) > 0 or len(self._running) > 0:
+                self._cond.wait()
+
+    def _next_job(self):
+        """Block until a job can be processed, and return it."""
+        with self._cond:
+            while True:
+                for uid in self._order:
+                    if uid not in self._running:
+                        self._order.remove(uid)
+                        self._running.add(uid)
+                        return uid, self._pending.pop(uid)
+                self._cond.wait()
+
+    def _work(self):
+        store = self._store_factory()
+        while True:
+            uid, changed = self._next_job()
+            try:
+                train(store, uid, changed, self._incremental, self._selector)
+                self._logger.info("trained model for user %d" % uid)
+            except Exception as ex:
+                self._logger.error("couldn't train model for user %d (%r)"
+                        % (uid, ex))
+                store.rollback()
+            finally:
+                with self._cond:
+                    self._running.discard(uid)
+                    self._cond.notify_all()
+
+
+class LocalQueue(object):
+    """In-process stand-in for the message queue.
+
+    Jobs are directly handed to a pool of workers running in the same process.
+    """
+
+    def __init__(self, trainer):
+        self._trainer = trainer
+
+    def put(self, uid, changed=None):
+        self._trainer.put(uid, changed)
+
+    def close(self):
+        pass
+
+
+class PublisherQueue(object):
+    """Sends the training jobs through a (shared) message publisher."""
+
+    def __init__(self, publisher):
+        self._publisher = publisher
+
+    def put(self, uid, changed=None):
+        self._publisher.publish(make_job(uid, changed))
+
+    def close(self):
+        # The publisher is shared, its connection is kept open.
+        pass
+
+
+class AMQPQueue(object):
+    """Consumer of the training jobs queue backed by RabbitMQ.
+
+    The jobs are sent through a PublisherQueue (see `get_queue`).
+    """
+
+    def __init__(self, host, name):
+        self._host = host
+        self._name = name
+        self._conn = None
+
+    def _channel(self):
+        if self._conn is None:
+            self._conn = pika.BlockingConnection(
+                    pika.ConnectionParameters(self._host))
+        channel = self._conn.channel()
+        # Creates the queue if it doesn't exist yet.
+        channel.queue_declare(queue=self._name, durable=True)
+        return channel
+
+    def consume(self, trainer):
+        """Forward the jobs of the queue to a trainer (blocks forever)."""
+        def callback(channel, method, properties, body):
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            message = json.loads(body)
+            if message.get('action') == ACTION:
+                trainer.put(message['uid'], message.get('changed'))
+        channel = self._channel()
+        channel.basic_consume(callback, queue=self._name)
+        channel.start_consuming()
+
+    def close(self):
+        """Close the connection to RabbitMQ (flushes all the messages)."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def make_job(uid, changed=None):
+    return json.dumps({
+      'action': ACTION,
+      'uid': uid,
+      'changed': changed,
+    })
+
+
+def train(store, uid, changed=None, incremental=True, selector=None):
+    """Generate a user's model and commit it to the database."""
+    # Make sure that we see the latest version of the user's library.
+    store.invalidate()
+    user = store.get(User, uid)
+    if user is None:
+        return
+    predict.Model(user).generate(store, incremental=incremental,
+            changed=changed, selector=selector)
+    store.commit()
+
+
+def train_many(uids, processes=None, incremental=False, patience=None):
+    """Generate the models of many users in parallel.
+
+    The users are distributed over a pool of processes (by default, one per
+    CPU). Yields (uid, success) pairs as the models are generated.
+    """
+    pool = multiprocessing.Pool(processes, initializer=_init_process,
+            initargs=(incremental, patience))
+    try:
+        for uid in pool.imap_unordered(_train_process, uids):
+            yield uid
+    finally:
+        pool.close()
+        pool.join()
+
+
+# State of the processes used by train_many.
+_process_state = dict()
+
+
+def _init_process(incremental, patience):
+    _process_state['store'] = utils.get_store()
+    _process_state['incremental'] = incremental
+    _process_state['selector'] = predict.ModelSelector(patience=patience)
+
+
+def _train_process(uid):
+    store = _process_state['store']
+    try:
+        train(store, uid, incremental=_process_state['incremental'],
+                selector=_process_state['selector'])
+    except Exception:
+        store.rollback()
+        return uid, False
+    return uid, True
+
+
+def get_queue(config):
+    """Get the training jobs queue described by the configuration.
+
+    Returns None if models are not trained in the background.
+    """
+    global _local_queue
+    options = config.get('training')
+    if options is None:
+        return None
+    if options.get('backend', 'amqp') == 'local':
+        with _local_queue_lock:
+            if _local_queue is None:
+                conn_str = config['database']['string']
+                trainer = Trainer(lambda: utils.get_store(conn_str),
+                        nb_workers=options.get('workers', 1))
+                trainer.start()
+                _local_queue = LocalQueue(trainer)
+        return _local_queue
+    return PublisherQueue(get_publisher(config))
+
+
+def get_publisher(config):
+    """Get the (shared) publisher of the training jobs."""
+    # Successive jobs for a user are meaningful, they must not be dropped.
+    return messaging.get_publisher(config, 'training', dedup_ttl=0)
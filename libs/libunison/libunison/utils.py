@@ -4,12 +4,15 @@
 import base64
 import marshal
 import math
+import numpy as np
 import os
 import os.path
-import struct
+import scipy.sparse
 import yaml
 import sqlite3
 import storm.locals
+import threading
+import time
 
 from functools import wraps
 from math import log, log1p
@@ -23,6 +26,7 @@ DB_PATH = '%s/tags.db' % GEN_ROOT
 WEIGHTS_PATH = '%s/weights.marshal' % GEN_ROOT
 
 QUERY_SELECT = "SELECT vector, weight FROM tags WHERE name = ?"
+QUERY_SELECT_ALL = "SELECT name, vector, weight FROM tags ORDER BY ROWID"
 
 
 def memo(func):
@@ -36,6 +40,93 @@ def memo(func):
     return wrap
 
 
+class LRUCache(object):
+    """Thread-safe dictionary of bounded size with LRU eviction.
+
+    Optionally, items expire `ttl` seconds after they were inserted. The
+    recency order is kept in a circular doubly-linked list, whose nodes are
+    [prev, next, key, value, expiry] lists.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data = dict()  # Maps keys to nodes.
+        self._root = []  # Sentinel node of the list.
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            node = self._data.get(key)
+            if node is None:
+                return default
+            if node[4] is not None and node[4] < time.time():
+                self._remove(key)
+                return default
+            # Move the item to the front to mark it as the most recently used.
+            self._unlink(node)
+            self._link(node)
+            return node[3]
+
+    def put(self, key, value):
+        with self._lock:
+            self._insert(key, value)
+
+    def add(self, key, value):
+        """Insert an item unless the key is already present (atomically).
+
+        Returns True if the item was inserted, False otherwise.
+        """
+        now = time.time()
+        with self._lock:
+            node = self._data.get(key)
+            if node is not None and (node[4] is None or node[4] >= now):
+                return False
+            self._insert(key, value)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            return self._remove(key)[3]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None, None]
+
+    def _insert(self, key, value):
+        expiry = time.time() + self._ttl if self._ttl is not None else None
+        if key in self._data:
+            self._remove(key)
+        node = [None, None, key, value, expiry]
+        self._data[key] = node
+        self._link(node)
+        while len(self._data) > self._max_size:
+            # Evict the least recently used item.
+            self._remove(self._root[0][2])
+
+    def _link(self, node):
+        """Insert a node at the front of the list."""
+        first = self._root[1]
+        node[0], node[1] = self._root, first
+        first[0] = node
+        self._root[1] = node
+
+    def _unlink(self, node):
+        node[0][1], node[1][0] = node[1], node[0]
+
+    def _remove(self, key):
+        node = self._data.pop(key)
+        self._unlink(node)
+        return node
+
+
 def _load(path):
     """Read a marshalled structure from disk."""
     f = open(path, 'rb')
@@ -93,22 +184,11 @@ def tag_features(tag, conn=None, normalize=False):
         tag  - the name of a tag
     and returns the feature vector associated with the tag (or None if the tag
     wasn't found in the database).
+
+    The lookup is served from the in-memory tag space of the database (see
+    TagSpace), which is loaded once per connection.
     """
-    if conn is None:
-        conn = get_feature_db()
-    res = conn.execute(QUERY_SELECT, (tag,)).fetchone()
-    if res is None:
-        return None, None
-    raw, weight = res
-    vector = list()
-    for i in xrange(0, len(raw), 4):
-        val, = struct.unpack('!f', raw[i:i+4])
-        vector.append(val)
-    if normalize:
-        norm = math.sqrt(sum([x*x for x in vector]))
-        if norm > 0:
-            return tuple([x / norm for x in vector]), weight
-    return tuple(vector), weight
+    return get_tag_space(conn).tag_features(tag, normalize)
 
 
 def track_features(tags, conn=None, tag_fct=None):
@@ -122,12 +202,14 @@ def track_features(tags, conn=None, tag_fct=None):
         @utils.memo
         def tag_fct(tag):
             return utils.tag_features(tag, conn=conn)
+
+    Without such a function, the track is embedded directly using the tag space
+    of the database.
     """
+    if tag_fct is None:
+        return get_tag_space(conn).track_features(tags)
     if conn is None:
         conn = get_feature_db()
-    if tag_fct is None:
-        # Small closure around tag_features.
-        tag_fct = lambda tag: tag_features(tag, conn=conn)
     vector = [0] * get_dimensions(conn)
     total = 0
     for tag, count in tags:
@@ -144,6 +226,151 @@ def track_features(tags, conn=None, tag_fct=None):
     return tuple([x / total for x in vector]) if total > 0 else None
 
 
+def track_features_batch(tag_lists, conn=None):
+    """Generate the feature vectors of many tracks at once.
+
+    Vectorized version of track_features. Returns a (nb_tracks, dimensions)
+    array, where the rows of tracks that cannot be embedded are NaN.
+    """
+    return get_tag_space(conn).track_features_batch(tag_lists)
+
+
+class TagSpace(object):
+    """In-memory representation of the tag features database.
+
+    The whole database is read once into a contiguous float32 matrix (one row
+    per tag), along with a dictionary that maps tag names to rows and a vector
+    of tag weights. Lookups and track embeddings are then computed without
+    touching the database.
+    """
+
+    def __init__(self, index, vectors, weights):
+        self._index = index
+        self._vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self._weights = np.asarray(weights, dtype=np.float64)
+
+    @classmethod
+    def load(cls, conn=None):
+        """Read the whole tag features database into memory."""
+        if conn is None:
+            conn = get_feature_db()
+        index = dict()
+        raws = list()
+        weights = list()
+        for name, raw, weight in conn.execute(QUERY_SELECT_ALL):
+            # Keep the first occurence of a tag, like QUERY_SELECT would.
+            index.setdefault(name, len(raws))
+            raws.append(str(raw))
+            weights.append(weight)
+        if len(raws) == 0:
+            return cls(index, np.zeros((0, 0)), weights)
+        vectors = np.frombuffer(''.join(raws), dtype='>f4')
+        return cls(index, vectors.reshape(len(raws), -1), weights)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, tag):
+        return tag in self._index
+
+    @property
+    def dimensions(self):
+        return self._vectors.shape[1]
+
+    @property
+    def vectors(self):
+        """The (nb_tags, dimensions) matrix of tag feature vectors."""
+        return self._vectors
+
+    @property
+    def weights(self):
+        """The vector of global tag weights."""
+        return self._weights
+
+    def row(self, tag):
+        """Get the row of a tag in the matrix (or None if unknown)."""
+        return self._index.get(tag)
+
+    def normalized(self):
+        """Get a copy of the space where all tag vectors have unit length."""
+        norms = np.sqrt((self._vectors.astype(np.float64) ** 2).sum(axis=1))
+        norms[norms == 0] = 1.0
+        return TagSpace(self._index, self._vectors / norms[:, np.newaxis],
+                self._weights)
+
+    def tag_features(self, tag, normalize=False):
+        """Get the feature vector and the weight of a tag.
+
+        Returns (None, None) if the tag is not in the space.
+        """
+        i = self._index.get(tag)
+        if i is None:
+            return None, None
+        vector = self._vectors[i].astype(np.float64)
+        if normalize:
+            norm = math.sqrt(np.dot(vector, vector))
+            if norm > 0:
+                vector /= norm
+        return tuple(vector.tolist()), self._weights[i].item()
+
+    def track_features(self, tags):
+        """Generate a feature vector for a track from its tags.
+
+        Equivalent to the module-level track_features function.
+        """
+        rows = list()
+        weights = list()
+        for tag, count in tags:
+            if count == 0:
+                continue
+            i = self._index.get(tag)
+            if i is None:
+                continue
+            rows.append(i)
+            weights.append(self._weights[i] * log1p(float(count)) / log(2))
+        total = sum(weights)
+        if total <= 0:
+            return None
+        vector = np.dot(weights, self._vectors[rows].astype(np.float64))
+        return tuple((vector / total).tolist())
+
+    def track_features_batch(self, tag_lists):
+        """Generate the feature vectors of many tracks at once.
+
+        Takes a list of tag lists (one for each track) and returns a (nb_tracks,
+        dimensions) array, computed as the product of a sparse track-tag weight
+        matrix with the tag features matrix. The rows of tracks that cannot be
+        embedded (e.g. none of their tags are known) are filled with NaN.
+        """
+        rows = list()
+        cols = list()
+        counts = list()
+        for i, tags in enumerate(tag_lists):
+            for tag, count in tags:
+                if count == 0:
+                    continue
+                j = self._index.get(tag)
+                if j is None:
+                    continue
+                rows.append(i)
+                cols.append(j)
+                counts.append(float(count))
+        # Only work on the tags that are actually used.
+        used, cols = np.unique(np.asarray(cols, dtype=np.int64),
+                return_inverse=True)
+        data = self._weights[used][cols] * np.log1p(counts) / log(2)
+        matrix = scipy.sparse.csr_matrix((data, (rows, cols)),
+                shape=(len(tag_lists), len(used)))
+        totals = np.asarray(matrix.sum(axis=1)).ravel()
+        features = matrix.dot(self._vectors[used].astype(np.float64))
+        features = np.asarray(features).reshape(len(tag_lists), self.dimensions)
+        # Compensate for the document's length, as in track_features.
+        valid = totals > 0
+        features[valid] /= totals[valid, np.newaxis]
+        features[~valid] = np.nan
+        return features
+
+
 def b64enc(raw):
     return base64.urlsafe_b64encode(raw).strip('=')
 
@@ -156,19 +383,26 @@ def b64dec(enc):
 
 
 def encode_features(features):
-    raw = str()
-    for val in features:
-        raw += struct.pack('!f', val)
+    raw = np.asarray(features, dtype='>f4').tobytes()
     return b64enc(raw).decode('ascii')
 
 
 def decode_features(encoded):
-    raw = b64dec(encoded)
-    features = list()
-    for i in xrange(0, len(raw), 4):
-        val, = struct.unpack('!f', raw[i:i+4])
-        features.append(val)
-    return features
+    return np.frombuffer(b64dec(encoded), dtype='>f4').tolist()
+
+
+def decode_features_batch(encoded_list):
+    """Decode a list of encoded feature vectors into a single matrix.
+
+    All the feature vectors must have the same dimension. Returns a (nb_vectors,
+    dimensions) array of doubles.
+    """
+    raws = [b64dec(encoded) for encoded in encoded_list]
+    if len(set(len(raw) for raw in raws)) > 1:
+        raise ValueError("feature vectors have different dimensions")
+    dim = len(raws[0]) / 4 if len(raws) > 0 else 0
+    matrix = np.frombuffer(''.join(raws), dtype='>f4')
+    return matrix.reshape(len(raws), dim).astype(np.float64)
 
 
 @memo
@@ -202,6 +436,11 @@ def print_track(track):
 @memo
 def get_config(path=None):
     """Get the configuration options for Unison."""
+    return load_config(path)
+
+
+def load_config(path=None):
+    """Read the configuration options from disk (not cached)."""
     if path is None:
         try:
             # Maybe an environment variable was set.
@@ -209,7 +448,8 @@ def get_config(path=None):
         except KeyError:
             # As a last resort, just try to find it in the working dir.
             path = 'config.yaml'
-    return yaml.load(open(path))
+    with open(path) as stream:
+        return yaml.load(stream)
 
 
 def get_store(conn_str=None):
@@ -220,6 +460,12 @@ def get_store(conn_str=None):
     return storm.locals.Store(database)
 
 
+@memo
+def get_tag_space(conn=None):
+    """Get the (cached) in-memory tag space for a tag features database."""
+    return TagSpace.load(conn)
+
+
 def get_feature_db(path=None):
     if path is None:
         path = get_config()['tagfeats']
@@ -48,7 +48,7 @@ CREATE TABLE track (
   image          text, -- As a URL.
   listeners      integer, -- Number of listeners on last.fm.
   tags           text, -- JSON array.
-  features       text, -- Base64 encoded.
+  raw_features   bytea, -- Features, as little-endian 4-byte floats.
   UNIQUE (artist, title)
 );
 CREATE INDEX track_artist_title_idx ON track(artist, title);
@@ -84,7 +84,10 @@ CREATE TABLE group_event (
   user_id        bigint REFERENCES "user",
   group_id       bigint REFERENCES "group",
   event_type     group_event_type NOT NULL,
+  track_id       bigint REFERENCES track, -- Only set for 'play' events.
   payload        text -- JSON encoded.
 );
 CREATE INDEX group_event_group_idx ON group_event(group_id);
 CREATE INDEX group_event_creation_time_idx ON group_event(creation_time);
+CREATE INDEX group_event_play_idx ON group_event(group_id, creation_time)
+    WHERE event_type = 'play';
@@ -25,10 +25,10 @@ import sqlite3
 import struct
 import sys
 
-from math import exp, log, log1p, sqrt
+from math import exp, log, sqrt
 from sklearn.naive_bayes import GaussianNB
 from sklearn.svm import SVC, NuSVC
-from libunison.utils import GEN_ROOT, memo, get_vector
+from libunison.utils import GEN_ROOT, TagSpace
 
 
 DEFAULT_TRACK_DB = '%s/trackdata.db' % GEN_ROOT
@@ -69,48 +69,29 @@ def decode(encoded):
 
 def gen_features(username, userdb, trackdb, tagdb, dim, out):
     f = open(out, 'w')
-    tagf = make_tag_features(tagdb)
+    space = TagSpace.load(tagdb)
     # Get the user's ROWID.
     user = userdb.execute(SELECT_USERID, (username,)).fetchone()
     # Iterate over all the tracks of that user.
+    statuses = list()
+    tag_lists = list()
     for row in userdb.execute(SELECT_TRACKS, (user[0],)):
         track = trackdb.execute(SELECT_TAGS, (row[0], row[1])).fetchone()
         if track is None:
             # Track was not found. Ignore it.
             continue
-        features = track_features(json.loads(track[0]), tagf, dim)
-        if features is None:
+        statuses.append(row[2])
+        tag_lists.append(json.loads(track[0]))
+    # Embed all the tracks in one go.
+    batch = space.track_features_batch(tag_lists)[:, :dim]
+    for status, features in zip(statuses, batch):
+        if np.isnan(features[0]):
             # Features couldn't be extracted. Ignore it.
             continue
-        f.write("%s|%s\n" % (row[2], encode(features)))
+        f.write("%s|%s\n" % (status, encode(features)))
     f.close()
 
 
-#_tag_freq = dict()
-def track_features(tags, tag_features, dimensions):
-    #global _tag_freq
-    vector = [0] * dimensions
-    total = 0
-    for tag, count in tags:
-        #_tag_freq[tag] = _tag_freq.get(tag, 0) + int(count)
-        curr, gw = tag_features(tag)
-        if curr is None:
-            continue
-        weight = gw * log1p(float(count)) / log(2)
-        vector = [(weight*x + y) for x, y in zip(curr, vector)]
-        total += weight
-    # Normalizing the vector would make us lose independence of features.
-    # However, we should still compensate for the document's length.
-    return tuple([x / total for x in vector]) if total > 0 else None
-
-
-def make_tag_features(conn):
-    @memo
-    def tag_features(tag):
-        return get_vector(conn, tag, normalize=False)
-    return tag_features
-
-
 def gen_model(trainset, dim, out):
     f = open(out, 'w')
     lines = open(trainset).readlines()
@@ -263,9 +244,6 @@ if __name__ == '__main__':
             tagdb = sqlite3.connect(args.tag_db),
             dim = args.dimensions,
             out = args.out)
-        #for tag in sorted(_tag_freq, key=_tag_freq.get, reverse=True):
-        #    if _tag_freq[tag] > 10:
-        #        print tag, _tag_freq[tag]
     elif args.action == 'genmodel':
         gen_model(args.trainset, args.dimensions, args.out)
     elif args.action == 'classify':
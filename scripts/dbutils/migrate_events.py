@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Store the played track alongside the play events.
+
+Fills in the `track_id` column of the play events that were recorded before
+the column was introduced. If the column doesn't exist yet, create it first:
+
+    ALTER TABLE group_event ADD COLUMN track_id bigint REFERENCES track;
+    CREATE INDEX group_event_play_idx ON group_event(group_id, creation_time)
+        WHERE event_type = 'play';
+"""
+
+import argparse
+import libunison.utils as uutils
+
+from libunison.models import GroupEvent, Track
+from storm.locals import *
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def migrate(batch_size, verbose):
+    store = uutils.get_store()
+    total = 0
+    last_id = 0
+    while True:
+        events = list(store.find(GroupEvent, (GroupEvent.id > last_id)
+                & (GroupEvent.event_type == u'play')
+                & (GroupEvent.track_id == None)
+                ).order_by(GroupEvent.id)[:batch_size])
+        if len(events) == 0:
+            break
+        for event in events:
+            payload = event.payload or {}
+            track = store.find(Track, (Track.artist == payload.get('artist'))
+                    & (Track.title == payload.get('title'))).one()
+            if track is not None:
+                event.track = track
+                total += 1
+        store.commit()
+        last_id = events[-1].id
+        if verbose:
+            print "migrated %d events..." % total
+    return total
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    total = migrate(args.batch_size, args.verbose)
+    print "done, %d events migrated." % total
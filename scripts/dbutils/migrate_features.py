@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Move the track features to the binary column.
+
+Fills in the `raw_features` column of the tracks for which we only have the
+base64 encoded features, then drops the `features` column so that the
+features are stored only once. If the binary column doesn't exist yet,
+create it first:
+
+    ALTER TABLE track ADD COLUMN raw_features bytea;
+
+Run this right after deploying the code that reads `raw_features` only. The
+space used by the dropped column is reclaimed by the next table rewrite
+(e.g. `VACUUM FULL track`).
+"""
+
+import argparse
+import libunison.utils as uutils
+import numpy as np
+
+from libunison._storm_ext import FeaturesVariable
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+QUERY_HAS_COLUMN = """
+    SELECT 1 FROM information_schema.columns
+    WHERE table_name = 'track' AND column_name = 'features'
+    """
+
+QUERY_SELECT = """
+    SELECT id, features FROM track
+    WHERE features IS NOT NULL AND raw_features IS NULL
+    LIMIT ?
+    """
+
+QUERY_UPDATE = "UPDATE track SET raw_features = ? WHERE id = ?"
+
+QUERY_DROP = "ALTER TABLE track DROP COLUMN features"
+
+
+def migrate(batch_size, verbose, drop=True):
+    store = uutils.get_store()
+    if store.execute(QUERY_HAS_COLUMN).get_one() is None:
+        # Already migrated.
+        return 0
+    total = 0
+    while True:
+        rows = store.execute(QUERY_SELECT, (batch_size,)).get_all()
+        if len(rows) == 0:
+            break
+        for tid, encoded in rows:
+            features = np.frombuffer(uutils.b64dec(encoded), dtype='>f4')
+            raw = features.astype(FeaturesVariable.DTYPE).tobytes()
+            store.execute(QUERY_UPDATE, (raw, tid))
+        store.commit()
+        total += len(rows)
+        if verbose:
+            print "migrated %d tracks..." % total
+    if drop:
+        store.execute(QUERY_DROP)
+        store.commit()
+    return total
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--verbose', action='store_true')
+    # Only copy the features, keep the base64 encoded column.
+    parser.add_argument('--keep-column', action='store_true')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    total = migrate(args.batch_size, args.verbose, drop=not args.keep_column)
+    print "done, %d tracks migrated." % total
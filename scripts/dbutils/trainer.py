@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Train the users' models in the background.
+
+This script listens to the training queue for users whose library changed, and
+generates their new model using a pool of workers.
+"""
+
+import argparse
+import libunison.predict as predict
+import libunison.training as training
+import libunison.utils as uutils
+import logging
+
+
+CONFIG = uutils.get_config()
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int,
+            default=CONFIG['training'].get('workers', 1))
+    # Number of processes used to fit the candidate models of a user.
+    parser.add_argument('--processes', type=int, default=1)
+    # Stop the model selection once the BIC has risen for that many k.
+    parser.add_argument('--patience', type=int)
+    return parser.parse_args()
+
+
+def _get_logger():
+    formatter = logging.Formatter('%(asctime)s: %(levelname)s - %(message)s')
+    handler = logging.StreamHandler()  # Log to stderr.
+    handler.setFormatter(formatter)
+    logger = logging.getLogger('trainer')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    logger = _get_logger()
+    conn_str = CONFIG['database']['string']
+    selector = predict.ModelSelector(args.processes, args.patience)
+    trainer = training.Trainer(lambda: uutils.get_store(conn_str),
+            nb_workers=args.workers, selector=selector, logger=logger)
+    trainer.start()
+    queue = training.AMQPQueue(CONFIG['training']['host'],
+            CONFIG['training']['name'])
+    logger.info("start listening on queue '%s'..." % CONFIG['training']['name'])
+    queue.consume(trainer)
@@ -2,7 +2,7 @@
 
 import argparse
 import libunison.utils as uutils
-import libunison.predict as predict
+import libunison.training as training
 
 from libunison.models import User
 from storm.locals import *
@@ -13,24 +13,39 @@ def _parse_args():
     parser.add_argument('user', nargs='*', type=int)
     parser.add_argument('--null', action='store_true')
     parser.add_argument('--all', action='store_true')
+    # Number of processes (by default, one per CPU).
+    parser.add_argument('--workers', type=int)
+    # Stop the model selection once the BIC has risen for that many k.
+    parser.add_argument('--patience', type=int)
+    # Send the jobs to the background workers instead.
+    parser.add_argument('--enqueue', action='store_true')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = _parse_args()
     store = uutils.get_store()
-    users = set()
+    uids = set()
     for uid in args.user:
         user = store.get(User, uid)
         if user is not None:
-            users.add(user)
+            uids.add(user.id)
     if args.all:
-        users.update(store.find(User))
+        uids.update(store.find(User).values(User.id))
     elif args.null:
-        users.update(store.find(User, User.model == None))
-    for user in users:
-        print "updating model for user %s..." % user.email
-        model = predict.Model(user)
-        model.generate(store)
-        print "    ... %d components" % model.get_nb_components()
-    store.commit()
+        uids.update(store.find(User, User.model == None).values(User.id))
+    store.close()
+    if args.enqueue:
+        publisher = training.get_publisher(uutils.get_config())
+        queue = training.PublisherQueue(publisher)
+        for uid in sorted(uids):
+            print "enqueuing model update for user %d..." % uid
+            queue.put(uid)
+        publisher.close()
+    else:
+        for uid, success in training.train_many(sorted(uids),
+                processes=args.workers, patience=args.patience):
+            if success:
+                print "updated model for user %d" % uid
+            else:
+                print "couldn't update model for user %d" % uid
@@ -25,13 +25,13 @@ def get_points(uid, store, start_dim=0, nb_dim=2):
         raise LookupError('uid %d not found in database' % uid)
     entries = store.find(LibEntry, (LibEntry.user == user)
             & (LibEntry.is_local == True) & (LibEntry.is_valid == True))
-    for entry in entries:
-        track = entry.track
-        if track.features is not None:
-            features = uutils.decode_features(track.features)
-            point = tuple(features[start_dim:start_dim+nb_dim])
-            pts.append(point)
-            labels[point] = u"%s - %s" % (track.artist, track.title)
+    tracks = [entry.track for entry in entries
+            if entry.track.raw_features is not None]
+    for track in tracks:
+        features = track.raw_features
+        point = tuple(features[start_dim:start_dim+nb_dim].tolist())
+        pts.append(point)
+        labels[point] = u"%s - %s" % (track.artist, track.title)
     return pts, labels
 
 
@@ -3,6 +3,10 @@
 
 This script listens to the message queue for new tracks in the system for which
 we don't have the tags yet. It respects the Last.fm API rate limits.
+
+A single consumer reads the jobs from the queue and hands them to a pool of
+worker threads. Every Last.fm API key has its own token bucket, and each
+request goes through whichever key has capacity.
 """
 
 import argparse
@@ -11,27 +15,81 @@ import pika
 import liblfm
 import libunison.utils as uutils
 import logging
+import Queue
 import time
 import threading
 
 from libunison.models import Track
 
 
-DEFAULT_RATE = 1.0  # Maximal number of items processed every second.
+DEFAULT_RATE = 1.0  # Maximal number of requests per second and per key.
+DEFAULT_BURST = 5  # Maximal number of requests in a burst, per key.
+
+# Jobs identical to one processed within this interval are dropped.
+RECENT_TTL = 60 * 60  # In seconds.
+RECENT_SIZE = 100000
 CONFIG = uutils.get_config()
 
 
-class Fetcher(threading.Thread):
-    """Last.fm track tags fetcher.
+class TokenBucket(object):
+    """Thread-safe token bucket.
+
+    Tokens are added at a constant `rate` (per second), up to `burst` tokens.
+    Since the tokens are taken when the requests start, the time spent on the
+    requests doesn't slow down the rate.
+    """
+
+    def __init__(self, rate, burst=1):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Take a token if one is available.
+
+        Returns 0 on success, or else the time (in seconds) until the next
+        token becomes available.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._burst,
+                    self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self._rate
 
-    Listens for jobs on the message queue, and processes them sequentially at a
-    given rate (in order to respect the Last.fm API rate limits).
+
+class Scheduler(object):
+    """Dispatches the requests over many API keys.
+
+    Each key (i.e. each LastFM client) has its own token bucket.
     """
 
-    def __init__(self, rate, lfm, store, logger):
-        self._rate = rate
-        self._lfm = lfm
-        self._store = store
+    def __init__(self, clients, rate, burst):
+        self._buckets = [(client, TokenBucket(rate, burst))
+                for client in clients]
+
+    def acquire(self):
+        """Block until some key has capacity, and return its client."""
+        while True:
+            wait = None
+            for client, bucket in self._buckets:
+                delay = bucket.try_acquire()
+                if delay == 0:
+                    return client
+                wait = delay if wait is None else min(wait, delay)
+            time.sleep(wait)
+
+
+class Consumer(threading.Thread):
+    """Listens for jobs on the message queue and hands them to the workers."""
+
+    def __init__(self, jobs, logger):
+        self._jobs = jobs
         self._logger = logger
         self._conn = None
         threading.Thread.__init__(self)
@@ -56,27 +114,84 @@ class Fetcher(threading.Thread):
         self._conn.close()
 
     def _process(self, channel, method, properties, body):
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        # Blocks if the workers are lagging behind.
+        self._jobs.put(json.loads(body))
+
+
+class Fetcher(threading.Thread):
+    """Last.fm track tags fetcher.
+
+    Processes the jobs handed over by the consumer. The requests to Last.fm
+    are rate-limited by the scheduler, which is shared by all the fetchers.
+    """
+
+    def __init__(self, jobs, scheduler, store_factory, recent, logger):
+        self._jobs = jobs
+        self._scheduler = scheduler
+        self._store_factory = store_factory
+        self._store = None
+        # (action, artist, title) triples of the jobs processed recently.
+        self._recent = recent
+        self._logger = logger
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def run(self):
+        # The store is created in the thread that uses it.
+        self._store = self._store_factory()
+        while True:
+            message = self._jobs.get()
+            try:
+                self._process(message)
+            except Exception as ex:
+                self._logger.error("couldn't process job: %r (%r)"
+                        % (message, ex))
+                self._store.rollback()
+
+    def _process(self, message):
         """Process a message from the queue.
 
         Route the message to the correct function depending on the action.
         """
-        channel.basic_ack(delivery_tag=method.delivery_tag)
-        message = json.loads(body)
-        if message['action'] == 'track-tags':
-            self._track_tags(message['track'])
-        elif message['action'] == 'track-info':
-            self._track_info(message['track'])
-        # Wait for a while (implements the rate limiting).
-        time.sleep(1.0 / self._rate)
+        meta = message['track']
+        key = (message['action'], meta.get('artist'), meta.get('title'))
+        # Mark the job right away (atomically), so that other workers skip
+        # duplicates of a job that is in progress.
+        if not self._recent.add(key, True):
+            self._logger.info("skipping duplicate job: %r" % (key,))
+            return
+        done = False
+        try:
+            # Start a new transaction, to see the latest state of the tracks.
+            self._store.rollback()
+            if message['action'] == 'track-tags':
+                done = self._track_tags(meta)
+            elif message['action'] == 'track-info':
+                done = self._track_info(meta)
+        finally:
+            if not done:
+                # Only successful jobs are remembered, failed ones can be
+                # retried.
+                self._recent.pop(key)
 
     def _track_tags(self, meta):
+        """Fetch the tags of a track.
+
+        Returns False if the tags couldn't be fetched, True otherwise.
+        """
         track = self._store.find(Track, (Track.artist == meta['artist'])
                 & (Track.title == meta['title'])).one()
         if track is None:
             self._logger.warn("track not in database: %r" % meta)
-            return
+            return True
+        if track.tags is not None:
+            # Duplicate job, the tags were fetched in the meantime.
+            self._logger.info("track already has tags: %r" % meta)
+            return True
+        lfm = self._scheduler.acquire()
         try:
-            tags = self._lfm.top_tags(track.artist, track.title)
+            tags = lfm.top_tags(track.artist, track.title)
         except Exception as ex:
             if type(ex) is LookupError and ex.args[0] == 'Track not found':
                 # Track not found => no tags.
@@ -85,39 +200,54 @@ class Fetcher(threading.Thread):
             else:
                 self._logger.error("couldn't fetch tags for: %r (%r)"
                         % (meta, ex))
+                return False
         else:
             features = uutils.track_features(tags)
             self._store_tags(track, tags, features)
             self._logger.info("fetched tags for track: %r" % meta)
+        return True
 
     def _store_tags(self, track, tags, features=None):
         """Store a track's tags in the database."""
         track.tags = json.dumps(tags).decode('utf-8')
         if features is not None:
-            track.features = uutils.encode_features(features)
+            track.raw_features = features
         self._store.commit()
 
     def _track_info(self, meta):
+        """Fetch the image and the number of listeners of a track.
+
+        Returns False if the information couldn't be fetched, True otherwise.
+        """
         track = self._store.find(Track, (Track.artist == meta['artist'])
                 & (Track.title == meta['title'])).one()
         if track is None:
             self._logger.warn("track not in database: %r" % meta)
-            return
+            return True
+        if track.listeners is not None:
+            # Duplicate job, the info was fetched in the meantime.
+            self._logger.info("track already has info: %r" % meta)
+            return True
+        lfm = self._scheduler.acquire()
         try:
-            info = self._lfm.track_info(track.artist, track.title)
+            info = lfm.track_info(track.artist, track.title)
         except Exception as ex:
             self._logger.warn("couldn't fetch infos for: %r (%r)"
                     % (meta, ex))
-        else:
-            track.image = info['image']
-            track.listeners = info['listeners']
-            self._store.commit()
-            self._logger.info("fetched track info for: %r" % meta)
+            return False
+        track.image = info['image']
+        track.listeners = info['listeners']
+        self._store.commit()
+        self._logger.info("fetched track info for: %r" % meta)
+        return True
 
 
 def _parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--rate', type=float, default=DEFAULT_RATE)
+    parser.add_argument('--burst', type=int, default=DEFAULT_BURST)
+    # Number of worker threads (by default, one per API key).
+    parser.add_argument('--workers', type=int)
     return parser.parse_args()
 
 
@@ -134,9 +264,15 @@ def _get_logger():
 if __name__ == '__main__':
     args = _parse_args()
     logger = _get_logger()
-    for key in [CONFIG['lastfm']['key']] + CONFIG['lastfm']['addkeys']:
-        lfm = liblfm.LastFM(key)
-        store = uutils.get_store(CONFIG['database']['string'])
-        fetcher = Fetcher(args.rate, lfm, store, logger)
-        # Launch the fetcher !
-        fetcher.start()
+    keys = [CONFIG['lastfm']['key']] + CONFIG['lastfm']['addkeys']
+    scheduler = Scheduler([liblfm.LastFM(key) for key in keys],
+            args.rate, args.burst)
+    nb_workers = args.workers or len(keys)
+    jobs = Queue.Queue(maxsize=2 * nb_workers)
+    recent = uutils.LRUCache(RECENT_SIZE, ttl=RECENT_TTL)
+    conn_str = CONFIG['database']['string']
+    for i in xrange(nb_workers):
+        Fetcher(jobs, scheduler, lambda: uutils.get_store(conn_str), recent,
+                logger).start()
+    # Launch the fetcher !
+    Consumer(jobs, logger).start()
@@ -1,34 +1,47 @@
 import libunison.password as password
 import libunison.mail as mail
+import libunison.pool as pool
 import urllib
-import yaml
 
 from flask import Flask, render_template, request, g, redirect
 from libunison.models import User
-from storm.locals import create_database, Store
 
 
 app = Flask(__name__)
 
+# Configuration and database connections, reloaded when the file changes.
+_state = pool.AppState()
+
 
 @app.before_request
 def setup_request():
-    # Read the configuration.
-    stream = open('%s/config.yaml' % request.environ['UNISON_ROOT'])
-    g.config = yaml.load(stream)
-    # Set up the database.
-    database = create_database(g.config['database']['string'])
-    g.store = Store(database)
+    # Get the configuration (read once) and a store from the pool.
+    state = get_state(request.environ['UNISON_ROOT'])
+    g.config = state.config
+    g.pool = state.pool
+    g.store = g.pool.get()
 
 
 @app.after_request
-def teardown_request(response):
-    # Commit & close the database connection.
+def commit_request(response):
+    # Commit the changes made during the request.
     g.store.commit()
-    g.store.close()
     return response
 
 
+@app.teardown_request
+def teardown_request(exc):
+    # Give the store back to the pool (even if the request failed).
+    store = getattr(g, 'store', None)
+    if store is not None:
+        g.pool.put(store)
+
+
+def get_state(root):
+    """Get the configuration and the store pool of the app."""
+    return _state.setup('%s/config.yaml' % root)
+
+
 @app.route('/')
 def homepage():
     return render_template('home.html')